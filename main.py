@@ -3,7 +3,9 @@ Software entry point.
 """
 
 import json
+import os
 import subprocess
+import tempfile
 import tarfile
 import multiprocessing
 import sys
@@ -14,6 +16,10 @@ from src.conservation_parser import ConservationParser
 from src.shape_parser import ShapeParser
 from src.shape_scorer import ShapeScorer
 from src.rna_folder import RNAFolder
+from src.feature_extractor import FeatureExtractor
+from src.site_prescreen import SitePrescreen
+from src.streaming_scheduler import StreamingScheduler
+from src.seed_families import SeedFamilies
 
 
 def load_config():
@@ -55,6 +61,119 @@ def run_subprocess(command, error_message):
         sys.exit(1)
 
 
+def run_representative_subprocess(command, seed_families, error_message):
+    """ Run an R stage for only the representative miRNA of each seed family, by pointing it at a filtered copy of the config """
+
+    if len(seed_families.representatives) == 0:
+        return  # an empty miRNA filter would otherwise mean every miRNA
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        config_path = seed_families.write_config(os.path.join(config_dir, "config.json"), seed_families.representatives)
+        run_subprocess([config_path if arg == CONFIG_PATH else arg for arg in command], error_message)
+
+
+def prepare_shape_data(settings):
+    """ Extract the precompiled shape data if requested, otherwise use any fresh data in the shape folder """
+
+    if literal_eval(settings["use_precompiled_shape"]):
+        print("Using precompiled data...")
+        with tarfile.open(PRECOMPILED_CONSERVATION_PATH, "r:gz") as tar:
+            tar.extractall(path=".")
+    else:
+        print("Using fresh data...")
+
+
+def load_site_prescreen(settings, directories, cores):
+    """ Prepare the binding site pre-screen, loading its trained model if pre-screening is enabled and halting execution if there isn't one """
+
+    site_prescreen = SitePrescreen(settings, directories, cores)
+    if literal_eval(settings["use_prescreen"]):
+        try:
+            site_prescreen.load()
+        except FileNotFoundError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+
+    return site_prescreen
+
+
+def stream_mirnas(settings, directories, cores, seed_families):
+    """ Stream each seed family through stages 03 to 11, rather than running each stage for every miRNA in turn """
+
+    prepare_shape_data(settings)
+
+    streaming_scheduler = StreamingScheduler(settings, directories, cores)
+    streaming_scheduler.run()
+    streaming_scheduler.report()
+
+    seed_families.write_summary()
+
+
+def locate_binding_sites(settings, cores, seed_families, site_prescreen):
+    """ Locate the binding sites of each family's representative, share them with the family and then pre-screen (or restore) each miRNA's sites """
+
+    run_representative_subprocess(["Rscript", "src/locate_binding_sites.r", CONFIG_PATH, cores], seed_families, "An error occurred while locating binding sites.")
+    seed_families.share_bindings_batch()
+    seed_families.write_target_sites()
+
+    if literal_eval(settings["use_prescreen"]):
+        print("Pre-screening binding sites...")
+        site_prescreen.screen_batch()
+    else:
+        site_prescreen.restore_batch()
+
+
+def extract_folding_windows(cores, seed_families):
+    """ Extract the folding windows of each family's representative, then build each member's own windows from them """
+
+    run_representative_subprocess(["Rscript", "src/extract_windows.r", CONFIG_PATH, cores], seed_families, "An error occurred while extracting folding windows.")
+    seed_families.share_windows_batch()
+
+
+def fold_sequences(settings, directories, cores, seed_families):
+    """ Fold the target-side windows of each family's representative and the cofold windows of every miRNA, then share the target-side folds """
+
+    rna_folder = RNAFolder(settings, directories, cores, 6)
+
+    rna_folder.run_rnafold_batch("windows_rnafold_lr", "folds_rnafold_lr", seed_families.representatives)
+    rna_folder.run_rnafold_batch("windows_rnafold_rl", "folds_rnafold_rl", seed_families.representatives)
+    rna_folder.run_rnafold_batch("windows_rnafold_ctr", "folds_rnafold_ctr", seed_families.representatives)
+
+    rna_folder.run_rnacofold_batch("windows_rnacofold_full", "folds_rnacofold_full")
+    rna_folder.run_rnacofold_batch("windows_rnacofold_seed", "folds_rnacofold_seed")
+
+    rna_folder.run_rnaplfold_batch(seed_families.representatives)
+    seed_families.share_folds_batch()
+
+
+def extract_features(settings, directories, cores):
+    """ Extract the features of every miRNA's binding sites, using either the vectorised feature engine or extract_features.r """
+
+    if literal_eval(settings["use_vectorised_features"]):
+        feature_extractor = FeatureExtractor(settings, directories, cores)
+        feature_extractor.extract_batch()
+    else:
+        run_subprocess(["Rscript", "src/extract_features.r", CONFIG_PATH, cores], "An error occurred while extracting features.")
+
+
+def parse_conservation_scores(settings, directories, cores, seed_families):
+    """ Parse the conservation scores of each family's representative, then share them with the family """
+
+    conservation_parser = ConservationParser(settings, directories, cores)
+    conservation_parser.parse_batch(seed_families.representatives)
+    seed_families.share_conservation_batch()
+
+
+def parse_shape_values(settings, directories, cores, seed_families):
+    """ Parse the shape reactivity values of each family's representative, then share them with the family """
+
+    prepare_shape_data(settings)
+
+    shape_parser = ShapeParser(settings, directories, cores)
+    shape_parser.parse_batch(seed_families.representatives)
+    seed_families.share_shape_batch()
+
+
 def main(config):
     """ Run each step of the algorithm sequentially to extract and process features in order to ultimately produce predictions """
 
@@ -81,46 +200,38 @@ def main(config):
     run_subprocess(["Rscript", "src/generate_conservation_scores.r", CONFIG_PATH, cores], "An error occurred while generating conservation scores.")
     print("02/11 Complete.\n")
 
+    # miRNAs sharing a seed share all work which depends only on the seed, which is done once by each family's representative
+    seed_families = SeedFamilies(settings, directories)
+    site_prescreen = load_site_prescreen(settings, directories, cores)
+
+    if literal_eval(settings["use_streaming"]):
+        print("03-11/11 Streaming each miRNA through locating, windowing, folding, feature extraction, scoring, imputation and prediction...")
+        stream_mirnas(settings, directories, cores, seed_families)
+        print("03-11/11 Complete.\n")
+        return
+
     print("03/11 Locating binding sites for each miRNA...")
-    run_subprocess(["Rscript", "src/locate_binding_sites.r", CONFIG_PATH, cores], "An error occurred while locating binding sites.")
+    locate_binding_sites(settings, cores, seed_families, site_prescreen)
     print("03/11 Complete.\n")
 
     print("04/11 Extracting folding windows for each miRNA...")
-    run_subprocess(["Rscript", "src/extract_windows.r", CONFIG_PATH, cores], "An error occurred while extracting folding windows.")
+    extract_folding_windows(cores, seed_families)
     print("04/11 Complete.\n")
 
     print("05/11 Folding sequences using ViennaRNA...")
-    rna_folder = RNAFolder(settings, directories, cores, 6)
-
-    rna_folder.run_rnafold_batch("windows_rnafold_lr", "folds_rnafold_lr")
-    rna_folder.run_rnafold_batch("windows_rnafold_rl", "folds_rnafold_rl")
-    rna_folder.run_rnafold_batch("windows_rnafold_ctr", "folds_rnafold_ctr")
-
-    rna_folder.run_rnacofold_batch("windows_rnacofold_full", "folds_rnacofold_full")
-    rna_folder.run_rnacofold_batch("windows_rnacofold_seed", "folds_rnacofold_seed")
-
-    rna_folder.run_rnaplfold_batch()
+    fold_sequences(settings, directories, cores, seed_families)
     print("05/11 Complete.\n")
 
     print("06/11 Extracting features for each miRNA...")
-    run_subprocess(["Rscript", "src/extract_features.r", CONFIG_PATH, cores], "An error occurred while extracting features.")
+    extract_features(settings, directories, cores)
     print("06/11 Complete.\n")
 
     print("07/11 Parsing conservation scores for each miRNA...")
-    conservation_parser = ConservationParser(settings, directories, cores)
-    conservation_parser.parse_batch()
+    parse_conservation_scores(settings, directories, cores, seed_families)
     print("07/11 Complete.\n")
 
     print("08/11 Parsing shape reactivity values for each miRNA...")
-    if literal_eval(settings["use_precompiled_shape"]):
-        print("Using precompiled data...")
-        with tarfile.open(PRECOMPILED_CONSERVATION_PATH, "r:gz") as tar:
-            tar.extractall(path=".")
-    else:
-        print("Using fresh data...")
-
-    shape_parser = ShapeParser(settings, directories, cores)
-    shape_parser.parse_batch()
+    parse_shape_values(settings, directories, cores, seed_families)
     print("08/11 Complete.\n")
 
     print("09/11 Producing average shape scores for each miRNA...")
@@ -138,6 +249,8 @@ def main(config):
     machine_learning.predict()
     print("11/11 Complete.\n")
 
+    seed_families.write_summary()
+
 
 # Entry point
 CONFIG_PATH = "config.json"
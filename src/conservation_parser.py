@@ -23,7 +23,7 @@ class ConservationParser:
 
         return np.nan if "NA" in raw_scores or len(raw_scores) == 0 else np.mean(np.array(raw_scores, dtype=np.float32))
 
-    def _score_target(self, binding_site_pos, conservation):
+    def score_target(self, binding_site_pos, conservation):
         """ Score a specific target by getting the mean across its bases """
 
         # match pos is relative to the 6mer, additionally it counts wrong because python goes from 0 whereas R goes from 1
@@ -46,6 +46,17 @@ class ConservationParser:
             self._compute_mean_score(conservation[start_5:end_5])
         )
 
+    def _count_target_sites(self, features_with_cons, row_index):
+        """ Count the target sites of the transcript starting at the given row """
+
+        # count the rows actually present rather than trusting site_abundance_6mer, as pre-screening may have pruned some of the transcript's sites
+        transcript_ids = features_with_cons["ensembl_transcript_id_version"]
+        mts_count = 1
+        while row_index + mts_count < len(transcript_ids) and transcript_ids.iloc[row_index + mts_count] == transcript_ids.iloc[row_index]:
+            mts_count += 1
+
+        return mts_count
+
     def _populate_features_with_cons(self, transcript, features_with_cons, conservation_row, conservation_track):
         """ Walk a row of the features table, recursively handling any instances of multiple target sites, by parsing and computing mean conservation scores for each """
 
@@ -65,12 +76,12 @@ class ConservationParser:
             return self._populate_features_with_cons(next_target, features_with_cons, conservation_row, conservation_track)
 
         # process each (instance of multiple) target site
-        mts_count = features_with_cons.iloc[transcript.row_index]["site_abundance_6mer"]
+        mts_count = self._count_target_sites(features_with_cons, transcript.row_index)
         for i in range(0, mts_count):
             current_index = transcript.row_index + i
             binding_site_pos = features_with_cons.iloc[current_index]["binding_site_pos"]
 
-            cons_seed, cons_sup, cons_3, cons_5 = self._score_target(binding_site_pos, conservation_row)
+            cons_seed, cons_sup, cons_3, cons_5 = self.score_target(binding_site_pos, conservation_row)
             features_with_cons.at[current_index, conservation_track.name + "_seed"] = cons_seed
             features_with_cons.at[current_index, conservation_track.name + "_sup"] = cons_sup
             features_with_cons.at[current_index, conservation_track.name + "_3"] = cons_3
@@ -119,11 +130,13 @@ class ConservationParser:
 
         print(f"Conservation parsing {str(file_index + 1)}/{str(file_count)} - done.")
 
-    def parse_batch(self):
+    def parse_batch(self, mirna_ids=None):
         """ Parse conservation scores for a batch of features files """
 
         with Pool(processes=self.cores) as pool:
             features_files = os.listdir(self.directories["features"])
+            if mirna_ids is not None:
+                features_files = [f for f in features_files if f.split(".")[0] in mirna_ids]
             file_count = len(features_files)
 
             pool.map(self.parse_conservation, [(features_filename, file_index, file_count) for (file_index, features_filename) in enumerate(features_files)])
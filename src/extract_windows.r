@@ -114,10 +114,10 @@ process_mirna <- function(i) {
         mirna_id <- mirna_ids[i]
         output_path <- file.path(directories$windows, binding_site_files[i])
 
-        raw_binding_sites <- read.table(file.path(directories$bindings_raw, binding_site_filename), sep = "\t", header = TRUE)
         expanded_binding_sites <- read.table(file.path(directories$bindings, binding_site_filename), sep = "\t", header = TRUE)
 
-        utrs <- utrs[rep(seq_len(nrow(raw_binding_sites)), raw_binding_sites$site_abundance_6mer), ]
+        # look up the utr for each site by transcript id, as pre-screening may have pruned some of a transcript's sites
+        utrs <- utrs[match(expanded_binding_sites$ensembl_transcript_id_version, utrs$ensembl_transcript_id_version), ]
 
         mirna_sequence <- mirna_sequences[mirna_sequences$mirna_id == mirna_id, ]$mirna_sequence
 
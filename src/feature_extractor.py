@@ -0,0 +1,417 @@
+"""
+Extract duplex, accessibility and positional features for every binding site of a miRNA using batched NumPy operations (a vectorised port of extract_features.r).
+"""
+
+import os
+from pathlib import Path
+from multiprocessing import Pool
+from ast import literal_eval
+import pandas as pd
+import numpy as np
+
+
+def _encode(strings, reverse=False):
+    """ Encode a collection of strings as a fixed-width uint8 array, optionally reversed, padding unused cells with 0 """
+
+    strings = [s[::-1] if reverse else s for s in strings]
+    width = max((len(s) for s in strings), default=0)
+
+    encoded = np.zeros((len(strings), width), dtype=np.uint8)
+    for row, string in enumerate(strings):
+        encoded[row, :len(string)] = np.frombuffer(string.encode("ascii"), dtype=np.uint8)
+
+    return encoded
+
+
+def _pair_code(base_a, base_b):
+    """ Combine two encoded base arrays into a single pair code so pair classes can be tested with np.isin """
+
+    return base_a.astype(np.uint16) * 256 + base_b
+
+
+def _pair_codes(pairs):
+    """ Build the pair codes for a list of two-letter base pairs, e.g. ["GC", "AU"] """
+
+    return [ord(a) * 256 + ord(b) for a, b in pairs]
+
+
+class FeatureExtractor:
+    """ A feature engine which encodes all duplexes of a miRNA as fixed-width arrays and computes each site's features in bulk """
+
+    PERFECT_PAIRS = _pair_codes(["GC", "CG", "AU", "UA"])
+    WOBBLE_PAIRS = _pair_codes(["UG", "GU", "AG", "GA", "UC", "CU", "AC", "CA"])
+    GU_PAIRS = _pair_codes(["GU", "UG"])
+
+    # windows over the miRNA side of the duplex used for the supplementary window features: bases 12-17, 09-20 and the full miRNA
+    WINDOWS = [("12_17", 12, 17), ("09_20", 9, 20), ("full", 1, 99)]
+    WINDOW_FEATURES = ["perfect_pair_count", "longest_any_sequence", "longest_any_sequence_start", "any_pair_avg_dist", "gu_count", "mrna_binding_spread"]
+
+    # 5' AU content is weighted by distance from the seed, 1/3 for the closest base down to 1/32 for the furthest
+    AU_WEIGHTS = np.array([1 / d for d in range(3, 33)]) / np.sum([1 / d for d in range(3, 33)])
+
+    def _read_rnafolds(self, folds_dir_name, mirna_id):
+        """ Read RNAfold output, which alternates every other line between the sequence and its structure prediction, into two columns """
+
+        with open(Path(self.directories[folds_dir_name], mirna_id + ".csv"), "r", encoding="utf-8") as folds_file:
+            lines = [line.rstrip("\n") for line in folds_file if line.strip() != ""]
+
+        return pd.DataFrame({"rnafold_sequence": lines[0::2], "rnafold_struct": lines[1::2]})
+
+    def _read_rnacofolds(self, folds_dir_name, mirna_id):
+        """ Read RNAcofold csv output, dropping the unneeded id columns """
+
+        rnacofolds = pd.read_csv(Path(self.directories[folds_dir_name], mirna_id + ".csv"), sep=",", header=0)
+        rnacofolds = rnacofolds.drop(columns=["seq_num", "seq_id"], errors="ignore")
+        rnacofolds.columns = ["sequence", "struct", "mfe"]
+
+        return rnacofolds
+
+    def _parse_mfe(self, structs):
+        """ Pull the (always negative) minimum free energy out of the tail of an RNAfold structure line, e.g. '..((...)).. ( -3.40)' """
+
+        digits = structs.str.replace(r"[^0-9.-]", "", regex=True).str.replace(r"^\D+", "", regex=True)
+        return pd.to_numeric("-" + digits, errors="coerce")
+
+    def _determine_most_likely_folds(self, rnafolds_lr, rnafolds_rl, rnafolds_ctr):
+        """ Compare the lr, rl and ctr folds of each site and keep the mfe and direction of whichever has the strongest binding """
+
+        mfe_lr = self._parse_mfe(rnafolds_lr["rnafold_struct"]).to_numpy()
+        mfe_rl = self._parse_mfe(rnafolds_rl["rnafold_struct"]).to_numpy()
+        mfe_ctr = self._parse_mfe(rnafolds_ctr["rnafold_struct"]).to_numpy()
+
+        # ties favour lr, then rl, then ctr
+        use_lr = (mfe_lr <= mfe_rl) & (mfe_lr <= mfe_ctr)
+        use_rl = (mfe_lr > mfe_rl) & (mfe_rl <= mfe_ctr)
+
+        return pd.DataFrame({
+            "rnafold_mfe": np.select([use_lr, use_rl], [mfe_lr, mfe_rl], mfe_ctr),
+            "rnafold_direction": np.select([use_lr, use_rl], [-1, 1], 0)
+        })
+
+    def _bound_bases(self, struct, open_char, close_char, side_mask):
+        """ Mark each base on one side of the duplex which binds across to the other side of the duplex """
+
+        opens = (struct == ord(open_char)) & side_mask
+        if not self.ignore_second_struct_bind:
+            return opens
+
+        # a self bind closes the most recent open bind on the same side, so an open bind only crosses the duplex if the running
+        # bind depth never drops back below it later on that side
+        closes = (struct == ord(close_char)) & side_mask
+        depth = np.cumsum(opens.astype(np.int32) - closes.astype(np.int32), axis=1)
+
+        later_min_depth = np.minimum.accumulate(depth[:, ::-1], axis=1)[:, ::-1]
+        later_min_depth = np.concatenate([later_min_depth[:, 1:], np.full((len(depth), 1), np.iinfo(np.int32).max)], axis=1)
+
+        return opens & (later_min_depth >= depth)
+
+    def _determine_bound(self, struct, rev_struct, lengths):
+        """ Mark the bases on either side of every duplex which bind across to the other side, along with the 1-based position of each & separator """
+
+        halfway = np.argmax(struct == ord("&"), axis=1)[:, None] + 1
+        mirna_side = np.arange(1, struct.shape[1] + 1)[None, :] < halfway
+        mrna_side = np.arange(rev_struct.shape[1])[None, :] < (lengths[:, None] - halfway)
+
+        mirna_bound = self._bound_bases(struct, "(", ")", mirna_side)
+        mrna_bound = self._bound_bases(rev_struct, ")", "(", mrna_side)  # the mrna side is bound from its 3' end, i.e. the start of the reversed duplex
+
+        return halfway, mirna_bound, mrna_bound
+
+    def _determine_pairs(self, seq, struct, rev_seq, rev_struct, lengths):
+        """ Work out which miRNA bases bind to the mRNA, the class of each pair and the position of the mRNA base each one pairs with, for every duplex at once """
+
+        halfway, mirna_bound, mrna_bound = self._determine_bound(struct, rev_struct, lengths)
+        mrna_count = mrna_bound.sum(axis=1)
+
+        # the nth miRNA bind pairs with the nth mRNA bind counting from the mRNA's 3' end
+        mirna_rank = np.cumsum(mirna_bound, axis=1) - 1
+        partner = np.take_along_axis(np.argsort(~mrna_bound, axis=1, kind="stable"), np.clip(mirna_rank, 0, mrna_bound.shape[1] - 1), axis=1)
+
+        considered = mirna_bound & ((mirna_bound.sum(axis=1) > 0) & (mrna_count > 0))[:, None]
+        pair_codes = _pair_code(seq, np.where(considered & (mirna_rank < mrna_count[:, None]), np.take_along_axis(rev_seq, partner, axis=1), 0))
+
+        perfect = np.isin(pair_codes, self.PERFECT_PAIRS)
+        return {
+            "considered": considered,
+            "perfect": perfect,
+            "wobble": np.isin(pair_codes, self.WOBBLE_PAIRS) & ~perfect,
+            "gu": np.isin(pair_codes, self.GU_PAIRS),
+            "mrna_pos": lengths[:, None] - halfway - partner  # position of the partner base relative to the & separator
+        }
+
+    def _update_runs(self, runs, pairs, col, prev_mirna_index):
+        """ Extend or end every duplex's current perfect and any-pair runs at one miRNA base, keeping track of the longest of each """
+
+        pos = col + 1
+        current = pairs["considered"][:, col]
+        is_perfect = current & pairs["perfect"][:, col]
+        is_wobble = current & pairs["wobble"][:, col]
+        is_any = is_perfect | is_wobble
+        is_unpaired = current & ~is_any
+
+        # a gap on the miRNA side ends any current runs
+        gap = current & (np.abs(pos - prev_mirna_index) > 1)
+        for name in ["curr_perfect", "curr_any", "curr_start"]:
+            runs[name][gap] = 0
+
+        runs["curr_start"] = np.where(is_any & (runs["curr_start"] == 0), pos, runs["curr_start"])
+
+        runs["curr_perfect"] = np.where(is_perfect, runs["curr_perfect"] + 1, np.where(is_wobble | is_unpaired, 0, runs["curr_perfect"]))
+        longer = is_perfect & (runs["curr_perfect"] > runs["longest_perfect"])
+        runs["longest_perfect"] = np.where(longer, runs["curr_perfect"], runs["longest_perfect"])
+        runs["longest_start"] = np.where(longer, runs["curr_start"], runs["longest_start"])
+
+        runs["curr_any"] = np.where(is_any, runs["curr_any"] + 1, np.where(is_unpaired, 0, runs["curr_any"]))
+        longer = is_any & (runs["curr_any"] > runs["longest_any"])
+        runs["longest_any"] = np.where(longer, runs["curr_any"], runs["longest_any"])
+        runs["longest_start"] = np.where(longer, runs["curr_start"], runs["longest_start"])
+
+        runs["curr_start"] = np.where(is_unpaired, 0, runs["curr_start"])
+
+    def _update_counts(self, counts, pairs, col):
+        """ Count every duplex's pairs, pair spacing and GU pairs at one miRNA base, and track the mRNA span its pairs cover """
+
+        pos = col + 1
+        current = pairs["considered"][:, col]
+        is_perfect = current & pairs["perfect"][:, col]
+        is_any = is_perfect | (current & pairs["wobble"][:, col])
+
+        counts["perfect_pair"] += is_perfect
+        counts["any_pair"] += is_any
+        counts["any_pair_dist"] += np.where(is_any & (counts["any_pair"] > 1), pos - counts["prev_mirna_index"], 0)
+        counts["gu"] += current & pairs["gu"][:, col]
+
+        counts["first_base_pos"] = np.where(is_any & (counts["first_base_pos"] == 0), pairs["mrna_pos"][:, col], counts["first_base_pos"])
+        counts["last_base_pos"] = np.where(is_any, pairs["mrna_pos"][:, col], counts["last_base_pos"])
+
+        counts["prev_mirna_index"] = np.where(current, pos, counts["prev_mirna_index"])
+
+    def _extract_window_features(self, pairs, start, end):
+        """ Walk the miRNA side of every duplex in lockstep to compute pair counts, runs, spacing, GU counts and mRNA spread for one window """
+
+        site_count, width = pairs["considered"].shape
+        counts = {name: np.zeros(site_count, dtype=np.int64)
+                  for name in ["perfect_pair", "any_pair", "any_pair_dist", "gu", "first_base_pos", "last_base_pos", "prev_mirna_index"]}
+        runs = {name: np.zeros(site_count, dtype=np.int64) for name in ["curr_perfect", "longest_perfect", "curr_any", "longest_any", "curr_start", "longest_start"]}
+
+        for col in range(max(start, 1) - 1, min(end, width)):
+            self._update_runs(runs, pairs, col, counts["prev_mirna_index"])
+            self._update_counts(counts, pairs, col)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            any_pair_avg_dist = np.where(counts["any_pair_dist"] != 0, counts["any_pair_dist"] / (counts["any_pair"] - 1), 0.0)
+
+        return [counts["perfect_pair"], runs["longest_any"], runs["longest_start"], any_pair_avg_dist, counts["gu"], counts["first_base_pos"] - counts["last_base_pos"]]
+
+    def _extract_base_features(self, seq, rev_seq, rev_struct, lengths):
+        """ Compute the single base and seed features for every RNAcofold duplex of a miRNA """
+
+        # bases are indexed by position from the miRNA's 5' end for the mirna, and from the window's 3' end for the mrna
+        def mirna_at(pos):
+            return seq[:, pos - 1]
+
+        def mrna_at(pos):
+            return rev_seq[:, pos - 1]
+
+        def paired_at(pos):
+            return (rev_struct[:, pos - 1] == ord(")")) & ~np.isin(_pair_code(mirna_at(pos), mrna_at(pos)), self.WOBBLE_PAIRS)
+
+        features = {}
+
+        # single base features
+        features["gu_1"] = np.isin(_pair_code(mirna_at(1), mrna_at(1)), self.GU_PAIRS)
+        features["gu_8"] = np.isin(_pair_code(mirna_at(8), mrna_at(8)), self.GU_PAIRS)
+        features["perfect_pair_9"] = np.isin(_pair_code(mirna_at(9), mrna_at(9)), self.PERFECT_PAIRS)
+        features["gu_9"] = np.isin(_pair_code(mirna_at(9), mrna_at(9)), self.GU_PAIRS)
+        features["perfect_pair_10"] = np.isin(_pair_code(mirna_at(10), mrna_at(10)), self.PERFECT_PAIRS)
+        features["gu_10"] = np.isin(_pair_code(mirna_at(10), mrna_at(10)), self.GU_PAIRS)
+        features["mirna_1"] = mirna_at(1).view("S1").astype(str)
+        features["mirna_8"] = mirna_at(8).view("S1").astype(str)
+        features["mrna_8"] = mrna_at(8).view("S1").astype(str)
+
+        # seed features- 6mer plus an A opposite miRNA base 1 (7mer-a1), a bind at base 8 (7mer-m8) or both (8mer)
+        condition_a1 = mrna_at(1) == ord("A")
+        condition_m8 = (lengths >= 8) & paired_at(8)
+        seed_binding_count = 6 + condition_a1.astype(np.int64) + condition_m8.astype(np.int64)
+
+        features["seed_binding_count"] = seed_binding_count
+        features["seed_binding_type"] = np.select(
+            [seed_binding_count == 8, condition_a1 & ~condition_m8, condition_m8 & ~condition_a1], ["8mer", "7mer-a1", "7mer-m8"], "6mer")
+        features["perfect_pair_1"] = paired_at(1)
+
+        return features
+
+    def _extract_duplex_features(self, rnacofolds):
+        """ Compute the seed, single base and window features for every RNAcofold duplex of a miRNA """
+
+        sequences = rnacofolds["sequence"].astype(str).tolist()
+        structs = rnacofolds["struct"].astype(str).tolist()
+        lengths = np.array([len(s) for s in sequences])
+
+        seq = _encode(sequences)
+        rev_seq = _encode(sequences, reverse=True)
+        rev_struct = _encode(structs, reverse=True)
+
+        features = self._extract_base_features(seq, rev_seq, rev_struct, lengths)
+
+        # window features
+        pairs = self._determine_pairs(seq, _encode(structs), rev_seq, rev_struct, lengths)
+        for window_name, start, end in self.WINDOWS:
+            window_features = self._extract_window_features(pairs, start, end)
+            features.update({f"{feature_name}_{window_name}": values for feature_name, values in zip(self.WINDOW_FEATURES, window_features)})
+
+        return pd.DataFrame(features)
+
+    def _extract_au_content_features(self, windows_lr, windows_rl):
+        """ Compute the 3', supplementary and distance weighted 5' AU content around each site """
+
+        au_window_lr = windows_lr.str[:-8]
+        au_window_rl = windows_rl.str[8:]
+        au_window_sup = windows_rl.str[10:18]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            au_content_3 = au_window_lr.str.count("[AU]") / au_window_lr.str.len()
+        au_content_sup = (au_window_sup.str.count("[AU]") / au_window_sup.str.len()).where(au_window_sup.str.len() > 0)
+
+        # weight each AU base by its distance from the seed; anything beyond the weighted range has no defined weight
+        rl = _encode(au_window_rl.tolist())
+        is_au = (rl == ord("A")) | (rl == ord("U"))
+        weights = np.full(rl.shape[1], np.nan)
+        weights[:min(len(self.AU_WEIGHTS), rl.shape[1])] = self.AU_WEIGHTS[:rl.shape[1]]
+        au_content_5_weighted = np.where(is_au, weights[None, :], 0).sum(axis=1)
+
+        return pd.DataFrame({"au_content_3": au_content_3.to_numpy(), "au_content_sup": au_content_sup.to_numpy(), "au_content_5_weighted": au_content_5_weighted})
+
+    def _load_rnaplfolds(self, mirna_id, folding_windows, seed_features):
+        """ Look up the probability that the seed and supplementary regions of each site are unpaired from its RNAplfold output """
+
+        rnaplfold_seed = np.full(len(folding_windows), np.nan)
+        rnaplfold_sup = np.full(len(folding_windows), np.nan)
+
+        start_6mer = folding_windows["rnaplfold_6mer_pos"].to_numpy()
+        start_seed = start_6mer - np.isin(seed_features["seed_binding_type"], ["7mer-a1", "8mer"])  # 7mer-a1 / 8mer starts at 1st base
+        base_20 = start_6mer + 7 + 11
+        seed_binding_count = seed_features["seed_binding_count"].to_numpy()
+
+        for i in range(len(folding_windows)):
+            # rnaplfold's output files are numbered sequence_0001 onwards
+            rnaplfold_file_path = Path(self.directories["folds_rnaplfold"], mirna_id, f"sequence_{i + 1:04d}_lunp")
+            if not rnaplfold_file_path.is_file() or rnaplfold_file_path.stat().st_size == 0:
+                continue
+
+            unpaired = pd.read_csv(rnaplfold_file_path, sep="\t", skiprows=2, header=None).iloc[:, 1:].to_numpy()
+
+            seed_row = start_seed[i] + seed_binding_count[i] - 1
+            if 0 <= seed_row < unpaired.shape[0] and seed_binding_count[i] <= unpaired.shape[1]:
+                rnaplfold_seed[i] = unpaired[seed_row, seed_binding_count[i] - 1]
+            if 0 <= base_20[i] - 1 < unpaired.shape[0] and unpaired.shape[1] >= 12:
+                rnaplfold_sup[i] = unpaired[base_20[i] - 1, 11]  # bases 09-20
+
+        return pd.DataFrame({"rnaplfold_seed": rnaplfold_seed, "rnaplfold_sup": rnaplfold_sup})
+
+    def _determine_best_abundance(self, combined_features):
+        """ For cases of abundance (MTS), flag the likely strongest candidate per transcript- most seed bases paired followed by strongest mfe """
+
+        best_abundance = (combined_features["site_abundance_6mer"] == 1).to_numpy(copy=True)
+
+        multiple = combined_features.loc[combined_features["site_abundance_6mer"] != 1]
+        if len(multiple) > 0:
+            # rank each transcript's sites, keeping the first site on ties; a candidate must beat a plain 6mer with no binding energy
+            group = (multiple["ensembl_transcript_id_version"] != multiple["ensembl_transcript_id_version"].shift()).cumsum()
+            ranked = multiple.assign(group=group).sort_values(["group", "seed_binding_count", "rnacofold_full_mfe"], ascending=[True, False, True], kind="stable")
+            best = ranked.groupby("group", sort=False).head(1)
+            best = best.loc[(best["seed_binding_count"] > 6) | (best["rnacofold_full_mfe"] < 0)]
+
+            best_abundance[combined_features.index.get_indexer(best.index)] = True
+
+        return best_abundance
+
+    def _combine_features(self, mirna_id, window_filename, expanded_binding_sites):
+        """ Extract the duplex, AU content, fold and accessibility features of each binding site and combine them with the sites' own features """
+
+        rnafolds_lr = self._read_rnafolds("folds_rnafold_lr", mirna_id)
+        rnafolds_rl = self._read_rnafolds("folds_rnafold_rl", mirna_id)
+        rnafolds_ctr = self._read_rnafolds("folds_rnafold_ctr", mirna_id)
+
+        rnacofolds_full = self._read_rnacofolds("folds_rnacofold_full", mirna_id)
+        rnacofolds_seed = self._read_rnacofolds("folds_rnacofold_seed", mirna_id)
+
+        duplex_features = self._extract_duplex_features(rnacofolds_full)
+        folding_windows = pd.read_csv(os.path.join(self.directories["windows"], window_filename), sep="\t")
+
+        # combine all extracted features into one table, keeping the column order of extract_features.r
+        return pd.concat([
+            expanded_binding_sites[["ensembl_transcript_id_version"]],
+            duplex_features[self.duplex_columns],
+            expanded_binding_sites.drop(columns=["ensembl_transcript_id_version"]),
+            self._extract_au_content_features(rnafolds_lr["rnafold_sequence"], rnafolds_rl["rnafold_sequence"]),
+            self._determine_most_likely_folds(rnafolds_lr, rnafolds_rl, rnafolds_ctr),
+            pd.DataFrame({"rnacofold_full_mfe": rnacofolds_full["mfe"], "rnacofold_seed_mfe": rnacofolds_seed["mfe"]}),
+            self._load_rnaplfolds(mirna_id, folding_windows, duplex_features)
+        ], axis=1)
+
+    def extract_features(self, args):
+        """ Extract the full set of features for each binding site of a miRNA and write them to a single table """
+
+        window_filename, file_index, file_count = args
+
+        mirna_id = window_filename.split(".")[0]
+        output_path = os.path.join(self.directories["features"], window_filename)
+
+        if self.use_caching and os.path.exists(output_path):
+            print(f"Feature extraction {file_index + 1}/{file_count} - loaded from cache.")
+            return
+
+        # a miRNA without target sites is given no features file, so it drops out of the later stages
+        expanded_binding_sites = pd.read_csv(os.path.join(self.directories["bindings"], window_filename), sep="\t")
+        if len(expanded_binding_sites) == 0:
+            print(f"Feature extraction {file_index + 1}/{file_count} - no target sites.")
+            return
+
+        combined_features = self._combine_features(mirna_id, window_filename, expanded_binding_sites)
+
+        # combine utr and cds length data
+        combined_features = pd.merge(combined_features, self.annotations, on="ensembl_transcript_id_version", sort=True)
+
+        # determine the closest utr end distance
+        dist_to_end = combined_features["X3_utr_length"] - combined_features["binding_site_pos"]
+        combined_features["dist_closest_utr_end"] = np.where(dist_to_end < combined_features["binding_site_pos"], dist_to_end, combined_features["binding_site_pos"])
+
+        combined_features["best_abundance"] = self._determine_best_abundance(combined_features)
+
+        # note: extract_features.r discounts each site from its own abundance on an intermediary frame which is never written,
+        # so the stored abundances are the raw counts- this is kept as-is as the trained model expects it
+
+        # output features, using R's representation of logicals and missing values so downstream stages read them identically
+        for column in combined_features.select_dtypes(include="bool").columns:
+            combined_features[column] = np.where(combined_features[column], "TRUE", "FALSE")
+        combined_features.to_csv(output_path, sep="\t", index=False, na_rep="NA")
+
+        print(f"Feature extraction {file_index + 1}/{file_count} - done.")
+
+    def extract_batch(self):
+        """ Extract features for a batch of miRNAs """
+
+        window_files = [f for f in os.listdir(self.directories["windows"]) if f.endswith(".tsv")]
+        if self.settings["mirna_id_filter"] != "":
+            window_files = [f for f in window_files if f in [mirna_id + ".tsv" for mirna_id in self.settings["mirna_id_filter"].split(",")]]
+
+        with Pool(processes=self.cores) as pool:
+            file_count = len(window_files)
+            pool.map(self.extract_features, [(window_filename, file_index, file_count) for (file_index, window_filename) in enumerate(window_files)])
+
+    def __init__(self, settings, directories, cores):
+        self.settings = settings
+        self.directories = directories
+        self.cores = int(cores)
+
+        self.use_caching = literal_eval(settings["use_caching"])
+        self.ignore_second_struct_bind = literal_eval(settings["ignore_second_struct_bind"])
+
+        self.duplex_columns = [
+            "gu_1", "gu_8", "perfect_pair_9", "gu_9", "perfect_pair_10", "gu_10", "mirna_1", "mirna_8", "mrna_8",
+            "seed_binding_count", "seed_binding_type", "perfect_pair_1"
+        ] + [f"{feature}_{window}" for window, _, _ in self.WINDOWS for feature in self.WINDOW_FEATURES]
+
+        annotations = pd.read_csv(Path(self.directories["annotations"], "annotations.tsv"), sep="\t")
+        self.annotations = annotations[["ensembl_transcript_id_version", "X3_utr_length", "cds_length"]]
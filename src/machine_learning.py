@@ -8,12 +8,14 @@ import csv
 import pandas as pd
 
 from src.prediction_model import PredictionModel
+from src.prediction_store import PredictionStore
 
 
 class MachineLearning:
     """ A utility class for managing a trained model and features in order to make predictions """
 
     model = None
+    store = None
     annotations = None
     mirna_ids = None
 
@@ -23,50 +25,74 @@ class MachineLearning:
         self.model = PredictionModel(self.settings, self.directories, self.cores)
         self.model.load(model_filename, scaler_filename)
 
-    def predict(self):
-        """ Make a set of predictions based on the supplied model and data for each miRNA """
+    def reset_predictions(self, mirna_ids):
+        """ Wipe any previous predictions so that a new run's predictions (for the given miRNAs) can be appended """
+
+        # note: the given miRNAs' stored predictions are each replaced as they are predicted, so only those of other miRNAs need clearing up front
+        self.store.retain_predictions(mirna_ids)
+
+        for name in ["all", "filtered"]:
+            if os.path.exists(self._output_path(name)):
+                os.remove(self._output_path(name))
+
+    def _output_path(self, name):
+        """ Get the path of one of the flat prediction outputs, either "all" or "filtered" """
+
+        return Path(self.directories["machine_learning"], f"{name}-predictions.tsv")
 
-        # wipe any previous predictions
-        output_path_all_pred = Path.joinpath(Path(self.directories["machine_learning"], "all-predictions.tsv"))
-        output_path_filtered_pred = Path.joinpath(Path(self.directories["machine_learning"], "filtered-predictions.tsv"))
+    def _append_predictions(self, predictions, name):
+        """ Append predictions to one of the flat prediction outputs """
 
-        if os.path.exists(output_path_all_pred):
-            os.remove(output_path_all_pred)
+        # note: the header is written by whichever miRNA creates the file, as miRNAs may be appended in any order
+        output_path = self._output_path(name)
+        predictions.to_csv(output_path, mode="a", sep="\t", index=False, header=not output_path.exists(), quoting=csv.QUOTE_NONE)
 
-        if os.path.exists(output_path_filtered_pred):
-            os.remove(output_path_filtered_pred)
+    def predict_mirna(self, mirna_id):
+        """ Make predictions for a single miRNA and append them to the prediction output """
 
-        annotations = pd.read_csv(Path(self.directories["annotations"], "annotations.tsv"), sep="\t")
+        if self.annotations is None:
+            self.annotations = pd.read_csv(Path(self.directories["annotations"], "annotations.tsv"), sep="\t")
 
         ensembl_transcript_id_filter = self.settings["ensembl_transcript_id_filter"].split(",")
         ensembl_gene_id_filter = self.settings["ensembl_gene_id_filter"].split(",")
         external_gene_id_filter = self.settings["external_gene_id_filter"].split(",")
 
-        mirna_files = os.listdir(self.directories["features_full_imputed"])
-        mirna_ids = [f.split(".")[0] for f in mirna_files]
+        predictions = self.model.predict(mirna_id)
 
-        # iterate each mirna and make predictions
-        for index, mirna_id in enumerate(mirna_ids):
-            predictions = self.model.predict(mirna_id)
+        # supplement predictions with annotations and reorganise the data to be more useful
+        merged_predictions = pd.merge(self.annotations, predictions, on="ensembl_transcript_id_version")
+        merged_predictions = merged_predictions[["mirna_id", "ensembl_transcript_id_version", "ensembl_gene_id", "external_gene_id", "binding_pos", "seed", "score"]]
+        merged_predictions = merged_predictions.sort_values(by="score", ascending=False)
 
-            # supplement predictions with annotations and reorganise the data to be more useful
-            merged_predictions = pd.merge(annotations, predictions, on="ensembl_transcript_id_version")
-            merged_predictions = merged_predictions[["mirna_id", "ensembl_transcript_id_version", "ensembl_gene_id", "external_gene_id", "binding_pos", "seed", "score"]]
-            merged_predictions = merged_predictions.sort_values(by="score", ascending=False)
+        # a site can be repeated (e.g. by a transcript appearing more than once in the annotations), so keep only its highest scoring row
+        merged_predictions = merged_predictions.drop_duplicates(subset=self.store.KEY[1:])
 
-            # output unfiltered predictions
-            merged_predictions.to_csv(output_path_all_pred, mode="a", sep="\t", index=False, header=(index == 1), quoting=csv.QUOTE_NONE)
+        # output unfiltered predictions, both as flat text and into the indexed store (replacing any previous run of this miRNA)
+        self._append_predictions(merged_predictions, "all")
+        self.store.add_predictions(mirna_id, merged_predictions)
 
-            # apply any transcript/gene filters supplied in the config
-            if self.settings["ensembl_transcript_id_filter"] != "":
-                merged_predictions = merged_predictions[merged_predictions["ensembl_transcript_id_version"].str.split(".").str[0].isin(ensembl_transcript_id_filter)]
-            if self.settings["ensembl_gene_id_filter"] != "":
-                merged_predictions = merged_predictions[merged_predictions["ensembl_gene_id"].isin(ensembl_gene_id_filter)]
-            if self.settings["external_gene_id_filter"] != "":
-                merged_predictions = merged_predictions[merged_predictions["external_gene_id"].isin(external_gene_id_filter)]
+        # apply any transcript/gene filters supplied in the config
+        if self.settings["ensembl_transcript_id_filter"] != "":
+            merged_predictions = merged_predictions[merged_predictions["ensembl_transcript_id_version"].str.split(".").str[0].isin(ensembl_transcript_id_filter)]
+        if self.settings["ensembl_gene_id_filter"] != "":
+            merged_predictions = merged_predictions[merged_predictions["ensembl_gene_id"].isin(ensembl_gene_id_filter)]
+        if self.settings["external_gene_id_filter"] != "":
+            merged_predictions = merged_predictions[merged_predictions["external_gene_id"].isin(external_gene_id_filter)]
 
-            # output filtered predictions
-            merged_predictions.to_csv(output_path_filtered_pred, mode="a", sep="\t", index=False, header=(index == 1), quoting=csv.QUOTE_NONE)
+        # output filtered predictions
+        self._append_predictions(merged_predictions, "filtered")
+
+    def predict(self):
+        """ Make a set of predictions based on the supplied model and data for each miRNA """
+
+        mirna_files = os.listdir(self.directories["features_full_imputed"])
+        mirna_ids = [f.split(".")[0] for f in mirna_files]
+
+        self.reset_predictions(mirna_ids)
+
+        # iterate each mirna and make predictions
+        for index, mirna_id in enumerate(mirna_ids):
+            self.predict_mirna(mirna_id)
 
             print(f"Predicting targets {index + 1}/{len(mirna_ids)} - done.")
 
@@ -74,3 +100,5 @@ class MachineLearning:
         self.settings = settings
         self.directories = directories
         self.cores = cores
+
+        self.store = PredictionStore(directories)
@@ -0,0 +1,185 @@
+"""
+Store predictions in an indexed SQLite database so that top-k, threshold and set-membership queries can be answered without scanning the flat TSV output.
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+from pathlib import Path
+
+
+class PredictionStore:
+    """ An embedded, indexed store of target predictions keyed by miRNA, transcript and gene """
+
+    COLUMNS = ["mirna_id", "ensembl_transcript_id_version", "ensembl_gene_id", "external_gene_id", "binding_pos", "seed", "score"]
+
+    KEY = ["mirna_id", "ensembl_transcript_id_version", "binding_pos"]
+
+    # the query filters which match ids exactly against a single column, as opposed to transcript ids which may be given without a version
+    ID_FILTERS = {"mirna_ids": "mirna_id", "gene_ids": "ensembl_gene_id", "external_gene_ids": "external_gene_id"}
+
+    # note: the table is clustered on its natural key (mirna_id, transcript, binding_pos) so a miRNA's predictions are stored contiguously,
+    # which lets a single miRNA be replaced without touching the rest of the store, while the (mirna_id, score desc) index makes top-k a short range scan
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS predictions (
+            mirna_id TEXT NOT NULL,
+            ensembl_transcript_id_version TEXT NOT NULL,
+            ensembl_gene_id TEXT,
+            external_gene_id TEXT,
+            binding_pos INTEGER NOT NULL,
+            seed TEXT,
+            score REAL NOT NULL,
+            PRIMARY KEY (mirna_id, ensembl_transcript_id_version, binding_pos)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_predictions_mirna ON predictions (mirna_id, score DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_predictions_transcript ON predictions (ensembl_transcript_id_version, score DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_predictions_gene ON predictions (ensembl_gene_id, score DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_predictions_external_gene ON predictions (external_gene_id, score DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_predictions_score ON predictions (score DESC)"
+    ]
+
+    def _connect(self):
+        """ Open a connection to the store, creating the schema on first use """
+
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+
+        with connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+        return connection
+
+    def add_predictions(self, mirna_id, predictions):
+        """ Add (or replace) the predictions for a single miRNA in one transaction, leaving all other miRNAs untouched """
+
+        rows = predictions[self.COLUMNS].itertuples(index=False, name=None)
+
+        with self._connect() as connection:
+            connection.execute("DELETE FROM predictions WHERE mirna_id = ?", (mirna_id,))
+            connection.executemany(f"INSERT INTO predictions ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})", rows)
+
+        connection.close()
+
+    def remove_predictions(self, mirna_ids):
+        """ Remove the predictions for the given miRNAs """
+
+        with self._connect() as connection:
+            connection.executemany("DELETE FROM predictions WHERE mirna_id = ?", [(mirna_id,) for mirna_id in mirna_ids])
+
+        connection.close()
+
+    def retain_predictions(self, mirna_ids):
+        """ Remove the predictions for every miRNA other than the given miRNAs, so that no miRNA from a previous run lingers in the store """
+
+        stale_ids = set(self.mirna_ids()) - set(mirna_ids)
+        if stale_ids:
+            self.remove_predictions(sorted(stale_ids))
+
+    def top_targets(self, mirna_id, k=100):
+        """ Get the k highest scoring predictions for a given miRNA """
+
+        return self.query(mirna_ids=[mirna_id], limit=k)
+
+    def _transcript_clause(self, transcript_ids, params):
+        """ Build the clause matching any of the given transcripts, which may be supplied with or without a version """
+
+        versioned = [t for t in transcript_ids if "." in t]
+        unversioned = [t for t in transcript_ids if "." not in t]
+
+        transcript_clauses = []
+        if versioned:
+            transcript_clauses.append(f"ensembl_transcript_id_version IN ({', '.join('?' * len(versioned))})")
+            params.extend(versioned)
+        for transcript_id in unversioned:
+            # a prefix range keeps this on the transcript index, unlike LIKE or a computed split
+            transcript_clauses.append("(ensembl_transcript_id_version >= ? AND ensembl_transcript_id_version < ?)")
+            params.extend([transcript_id + ".", transcript_id + "/"])
+
+        return f"({' OR '.join(transcript_clauses)})"
+
+    def query(self, min_score=None, limit=None, **filters):
+        """ Get predictions matching any supplied id filters (mirna_ids, transcript_ids, gene_ids, external_gene_ids) and score threshold, ordered by descending score """
+
+        unknown_filters = set(filters) - set(self.ID_FILTERS) - {"transcript_ids"}
+        if unknown_filters:
+            raise TypeError(f"Unknown prediction filters: {', '.join(sorted(unknown_filters))}")
+
+        clauses = []
+        params = []
+
+        # each filter is a set-membership test against an indexed column
+        for filter_name, column in self.ID_FILTERS.items():
+            if filters.get(filter_name):
+                clauses.append(f"{column} IN ({', '.join('?' * len(filters[filter_name]))})")
+                params.extend(filters[filter_name])
+
+        if filters.get("transcript_ids"):
+            clauses.append(self._transcript_clause(filters["transcript_ids"], params))
+
+        if min_score is not None:
+            clauses.append("score >= ?")
+            params.append(float(min_score))
+
+        sql = f"SELECT {', '.join(self.COLUMNS)} FROM predictions"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY score DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+
+        with self._connect() as connection:
+            results = [dict(row) for row in connection.execute(sql, params)]
+
+        connection.close()
+
+        return results
+
+    def mirna_ids(self):
+        """ Get the ids of every miRNA currently held in the store """
+
+        with self._connect() as connection:
+            ids = [row["mirna_id"] for row in connection.execute("SELECT DISTINCT mirna_id FROM predictions")]
+
+        connection.close()
+
+        return ids
+
+    def __init__(self, directories, filename="predictions.sqlite"):
+        self.directories = directories
+
+        Path(self.directories["machine_learning"]).mkdir(parents=True, exist_ok=True)
+        self.path = str(Path(self.directories["machine_learning"], filename))
+
+
+def main():
+    """ Command line entry point for querying a prediction store """
+
+    parser = argparse.ArgumentParser(description="Query the miRsight prediction store.")
+    parser.add_argument("--config", default="config.json", help="path to the miRsight config file")
+    parser.add_argument("--mirna", help="comma-separated miRNA ids, e.g. hsa-miR-129-5p,hsa-miR-30c-5p")
+    parser.add_argument("--transcript", help="comma-separated ensembl transcript ids, with or without version")
+    parser.add_argument("--gene", help="comma-separated ensembl gene ids")
+    parser.add_argument("--external-gene", help="comma-separated external gene ids, e.g. ESRRA,ARF5")
+    parser.add_argument("--min-score", type=float, help="only return predictions scoring at least this value")
+    parser.add_argument("--top", type=int, help="only return the k highest scoring predictions")
+    args = parser.parse_args()
+
+    with open(args.config, "r", encoding="utf-8") as config_file:
+        directories = json.load(config_file)["directories"]
+
+    def split(value):
+        return value.split(",") if value else None
+
+    results = PredictionStore(directories).query(args.min_score, args.top, mirna_ids=split(args.mirna), transcript_ids=split(args.transcript),
+                                                 gene_ids=split(args.gene), external_gene_ids=split(args.external_gene))
+
+    print("\t".join(PredictionStore.COLUMNS))
+    for row in results:
+        print("\t".join(str(row[column]) for column in PredictionStore.COLUMNS))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,10 @@ Utilise the ViennaRNA suite for RNA folding in order to compute information cruc
 """
 
 import os
+import re
+import json
+import shutil
+import hashlib
 import subprocess
 from pathlib import Path
 from multiprocessing import Pool
@@ -12,7 +16,188 @@ from ast import literal_eval
 class RNAFolder:
     """ A utility class for running preset batches of ViennaRNA suite RNA folding tools """
 
-    def run_rnafold_batch(self, input_dir_name, output_dir_name):
+    def _hash_file(self, path):
+        """ Compute a hash of a window file so progress records can be matched to the exact input they were made from """
+
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    def _load_progress(self, progress_path, input_hash):
+        """ Load the progress record for an output, or None if there isn't a usable one for this input """
+
+        if not self.use_caching or not progress_path.is_file():
+            return None
+
+        try:
+            with open(progress_path, "r", encoding="utf-8") as progress_file:
+                progress = json.load(progress_file)
+        except (OSError, ValueError):
+            return None  # a corrupt record is treated the same as a missing one
+
+        if progress.get("input_hash") != input_hash or progress.get("chunk_size") != self.chunk_size:
+            return None
+
+        return progress
+
+    def _save_progress(self, progress_path, progress):
+        """ Atomically replace the progress record for an output """
+
+        temp_path = Path(str(progress_path) + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as progress_file:
+            json.dump(progress, progress_file)
+            progress_file.flush()
+            os.fsync(progress_file.fileno())
+
+        os.replace(temp_path, progress_path)
+
+    def _is_cached(self, output_path, input_path):
+        """ Check whether an output was fully committed from the current input """
+
+        if not self.use_caching or not output_path.exists():
+            return False
+
+        progress = self._load_progress(Path(str(output_path) + ".progress"), self._hash_file(input_path))
+        return progress is not None and progress["complete"]
+
+    def _resume_progress(self, input_path, output_path):
+        """ Get the progress of an earlier, interrupted fold of the same input, or start afresh if there is none to resume from """
+
+        progress_path = Path(str(output_path) + ".progress")
+        partial_path = Path(str(output_path) + ".part")
+
+        input_hash = self._hash_file(input_path)
+        progress = self._load_progress(progress_path, input_hash)
+        if progress is None or progress["complete"] or not partial_path.exists() or (partial_path.is_file() and partial_path.stat().st_size < progress["bytes_written"]):
+            progress = {"input_hash": input_hash, "chunk_size": self.chunk_size, "windows_completed": 0, "bytes_written": 0, "complete": False}
+            self._save_progress(progress_path, progress)
+
+        return progress
+
+    def _remove_output(self, path):
+        """ Remove a fold output (or partial output), whether it is a single file or a folder of files """
+
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            os.remove(path)
+
+    def _fold_chunks(self, input_path, output_path, lines_per_window, fold_chunk):
+        """ Fold an input file in chunks of windows, checkpointing after each chunk so an interrupted fold resumes from the last completed one """
+
+        progress_path = Path(str(output_path) + ".progress")
+        partial_path = Path(str(output_path) + ".part")
+
+        with open(input_path, "r", encoding="utf-8") as input_file:
+            lines = input_file.read().splitlines()
+        window_count = -(-len(lines) // lines_per_window)
+
+        progress = self._resume_progress(input_path, output_path)
+        if progress["windows_completed"] > 0:
+            print(f"Resuming {input_path.stem} from window {progress['windows_completed'] + 1}/{window_count}.")
+
+        for start in range(progress["windows_completed"], window_count, self.chunk_size):
+            end = min(start + self.chunk_size, window_count)
+            chunk_lines = lines[start * lines_per_window:end * lines_per_window]
+
+            # a crash can leave output past the last checkpoint, so each chunk first rolls the partial output back to it
+            bytes_written = fold_chunk(chunk_lines, start, lines[:start * lines_per_window], progress["bytes_written"])
+            if bytes_written is None:
+                return False
+
+            progress.update({"windows_completed": end, "bytes_written": bytes_written})
+            self._save_progress(progress_path, progress)
+
+        # commit the finished output in one step so an incomplete fold can never be mistaken for a complete one
+        if not partial_path.exists():
+            partial_path.touch()  # no windows to fold
+        if partial_path.is_dir() or output_path.is_dir():
+            self._remove_output(output_path)  # a folder can't be replaced in one step, nor can a file replace a folder
+        os.replace(partial_path, output_path)
+
+        progress["complete"] = True
+        self._save_progress(progress_path, progress)
+
+        return True
+
+    def _fold_file(self, command, input_path, output_path, lines_per_window, header_prefix=None):
+        """ Fold an input file with a tool which writes its results to stdout, appending each chunk's results to a partial output file """
+
+        partial_path = Path(str(output_path) + ".part")
+
+        def fold_chunk(chunk_lines, start, _, checkpoint_bytes):
+            result = subprocess.run(command, input="\n".join(chunk_lines) + "\n", capture_output=True, text=True, check=False)
+            if result.returncode != 0:
+                return None
+
+            output = result.stdout
+            if header_prefix is not None and start > 0 and output.startswith(header_prefix):
+                output = output.split("\n", 1)[1] if "\n" in output else ""  # only the first chunk keeps the csv header
+
+            with open(partial_path, "a+b") as partial_file:
+                partial_file.truncate(checkpoint_bytes)
+                partial_file.seek(checkpoint_bytes)
+                partial_file.write(output.encode("utf-8"))
+                partial_file.flush()
+                os.fsync(partial_file.fileno())
+
+                return partial_file.tell()
+
+        return self._fold_chunks(input_path, output_path, lines_per_window, fold_chunk)
+
+    def run_rnafold(self, input_path, output_path):
+        """ Run the RNAfold tool for a single window file, returning whether it succeeded """
+
+        return self._fold_file(["RNAfold", "--noPS", f"--jobs={self.cores}"], input_path, output_path, 1)
+
+    def run_rnacofold(self, input_path, output_path):
+        """ Run the RNAcofold tool for a single window file, returning whether it succeeded """
+
+        # each cofold window is a sequence line followed by its constraint line
+        # note: seq_num restarts at 1 in each chunk, which is left as-is since every reader of the cofold output drops it (along with seq_id)
+        command = ["RNAcofold", f"--jobs={self.cores}", "-C", "--noPS", "--output-format=D"]
+        return self._fold_file(command, input_path, output_path, 2, header_prefix="seq_num")
+
+    def _run_rnaplfold_file(self, input_path, output_path):
+        """ Run the RNAplfold tool for a single window file, returning whether it succeeded """
+
+        partial_path = Path(str(output_path) + ".part")
+        scratch_path = Path(partial_path, "scratch")
+
+        # RNAplfold writes a folder of files rather than a single file, so a window file without windows is given an empty folder
+        if os.path.getsize(input_path) == 0:
+            self._remove_output(partial_path)
+            partial_path.mkdir()
+
+        def fold_chunk(chunk_lines, start, previous_lines, checkpoint_bytes):
+            # fold each chunk in a scratch folder, then renumber its per-sequence files to follow on from the previous chunks
+            shutil.rmtree(partial_path if start == 0 else scratch_path, ignore_errors=True)
+            scratch_path.mkdir(parents=True)
+
+            exit_code = subprocess.run(["RNAplfold", "-L", "40", "-W", "80", "-u", "14", "--auto-id", "-o"], input="\n".join(chunk_lines) + "\n",
+                                       cwd=scratch_path, text=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False).returncode
+            if exit_code != 0:
+                return None
+
+            id_offset = sum(1 for line in previous_lines if line.strip() != "")
+            for lunp_path in scratch_path.glob("*_lunp"):
+                sequence_id = int(re.search(r"_(\d+)_lunp$", lunp_path.name).group(1)) + id_offset
+                os.replace(lunp_path, Path(partial_path, f"sequence_{sequence_id:04d}_lunp"))
+
+            shutil.rmtree(scratch_path)
+            return checkpoint_bytes
+
+        return self._fold_chunks(input_path, output_path, 1, fold_chunk)
+
+    def _list_windows(self, input_dir, mirna_ids):
+        """ List the window files in a folder, optionally only those of the given miRNAs """
+
+        window_files = os.listdir(input_dir)
+        if mirna_ids is not None:
+            window_files = [f for f in window_files if Path(f).stem in mirna_ids]
+
+        return window_files
+
+    def run_rnafold_batch(self, input_dir_name, output_dir_name, mirna_ids=None):
         """ Run the RNAfold tool for a given set of input windows to inform accessibility using secondary structure prediction """
 
         self.current_batch += 1
@@ -20,23 +205,22 @@ class RNAFolder:
         input_dir = self.directories[input_dir_name]
         output_dir = self.directories[output_dir_name]
 
-        window_count = len(os.listdir(input_dir))
+        window_files = self._list_windows(input_dir, mirna_ids)
+        window_count = len(window_files)
 
-        for index, window_filename in enumerate(os.listdir(input_dir)):
+        for index, window_filename in enumerate(window_files):
 
             input_path = Path(input_dir, window_filename)
             output_path = Path(output_dir, input_path.stem + ".csv")
 
-            if self.use_caching and output_path.is_file():
+            if self._is_cached(output_path, input_path):
                 print(f"Folding part {self.current_batch}/{self.batch_count} - {index}/{window_count} - loaded from cache.")
+            elif self.run_rnafold(input_path, output_path):
+                print(f"Folding part {self.current_batch}/{self.batch_count} - {index}/{window_count} - done.")
             else:
-                exit_code = subprocess.call(f"RNAfold --noPS --jobs={self.cores} {str(input_path)} >> {str(output_path)}", shell=True)
-                if exit_code == 0:
-                    print(f"Folding part {self.current_batch}/{self.batch_count} - {index}/{window_count} - done.")
-                else:
-                    print("An error occurred running RNAfold for " + input_path.stem)
+                print("An error occurred running RNAfold for " + input_path.stem)
 
-    def run_rnacofold_batch(self, input_dir_name, output_dir_name):
+    def run_rnacofold_batch(self, input_dir_name, output_dir_name, mirna_ids=None):
         """ Run the RNAcofold tool for a given set of input windows for target binding structure prediction """
 
         self.current_batch += 1
@@ -44,21 +228,20 @@ class RNAFolder:
         input_dir = self.directories[input_dir_name]
         output_dir = self.directories[output_dir_name]
 
-        window_count = len(os.listdir(input_dir))
+        window_files = self._list_windows(input_dir, mirna_ids)
+        window_count = len(window_files)
 
-        for index, window_filename in enumerate(os.listdir(input_dir)):
+        for index, window_filename in enumerate(window_files):
 
             input_path = Path(input_dir, window_filename)
             output_path = Path(output_dir, input_path.stem + ".csv")
 
-            if self.use_caching and output_path.is_file():
+            if self._is_cached(output_path, input_path):
                 print(f"Folding part {self.current_batch}/{self.batch_count} - {index}/{window_count} - loaded from cache.")
+            elif self.run_rnacofold(input_path, output_path):
+                print(f"Folding part {self.current_batch}/{self.batch_count} - {index}/{window_count} - done.")
             else:
-                exit_code = subprocess.call(f"RNAcofold --jobs={self.cores} -C --noPS --output-format=D {str(input_path)} >> {str(output_path)}", shell=True)
-                if exit_code == 0:
-                    print(f"Folding part {self.current_batch}/{self.batch_count} - {index}/{window_count} - done.")
-                else:
-                    print(f"An error occurred running RNAcofold for {input_path.stem}")
+                print(f"An error occurred running RNAcofold for {input_path.stem}")
 
     def run_rnaplfold(self, args):
         """ Run a specific RNAplfold tool instance """
@@ -67,35 +250,53 @@ class RNAFolder:
 
         self.current_batch += 1
 
+        input_path = Path(input_dir, window_filename)
         output_path = Path(output_dir, Path(window_filename).stem)
 
-        if self.use_caching and Path(output_path, "sequence_0001_lunp").is_file():
+        if self._is_cached(output_path, input_path):
             print(f"Folding part {self.current_batch}/{self.batch_count} - {index + 1}/{window_count} - loaded from cache.")
-            return
-
-        output_path.mkdir(parents=True, exist_ok=True)
-        input_path = Path("..", "..", "..", "..", input_dir, window_filename)
-
-        exit_code = subprocess.call(f"RNAplfold -L 40 -W 80 -u 14 --auto-id -o < {str(input_path)}", cwd=output_path, shell=True, stderr=subprocess.DEVNULL)
-
-        if exit_code == 0:
+        elif self._run_rnaplfold_file(input_path, output_path):
             print(f"Folding part {self.current_batch}/{self.batch_count} - {index + 1}/{window_count} - done.")
-            subprocess.call("rm -f *_basepairs", cwd=output_path, shell=True)
         else:
             print("An error occurred running RNAplfold for " + input_path.stem)
 
-    def run_rnaplfold_batch(self):
+    def run_rnaplfold_batch(self, mirna_ids=None):
         """ Run the RNAplfold tool for a set of input windows to inform accessibility using secondary structure prediction """
 
         self.current_batch += 1
 
         with Pool(processes=self.cores) as pool:
-            window_files = os.listdir(self.directories["windows_rnaplfold"])
+            window_files = self._list_windows(self.directories["windows_rnaplfold"], mirna_ids)
             window_count = len(window_files)
 
             pool.map(self.run_rnaplfold, [(self.directories["windows_rnaplfold"], self.directories["folds_rnaplfold"],
                      window_filename, index, window_count) for (index, window_filename) in enumerate(window_files)])
 
+    def fold_mirna(self, mirna_id, include_target_side=True):
+        """ Run every fold for a single miRNA's windows, returning whether they all succeeded """
+
+        # note: the target-side folds can be left out for a miRNA which shares them with the rest of its seed family
+        folds = [
+            (self.run_rnacofold, "windows_rnacofold_full", "folds_rnacofold_full", ".csv"),
+            (self.run_rnacofold, "windows_rnacofold_seed", "folds_rnacofold_seed", ".csv")
+        ]
+        if include_target_side:
+            folds = [
+                (self.run_rnafold, "windows_rnafold_lr", "folds_rnafold_lr", ".csv"),
+                (self.run_rnafold, "windows_rnafold_rl", "folds_rnafold_rl", ".csv"),
+                (self.run_rnafold, "windows_rnafold_ctr", "folds_rnafold_ctr", ".csv")
+            ] + folds + [(self._run_rnaplfold_file, "windows_rnaplfold", "folds_rnaplfold", "")]
+
+        for fold, input_dir_name, output_dir_name, extension in folds:
+            input_path = Path(self.directories[input_dir_name], mirna_id + ".txt")
+            output_path = Path(self.directories[output_dir_name], mirna_id + extension)
+
+            if not self._is_cached(output_path, input_path) and not fold(input_path, output_path):
+                print(f"An error occurred folding {input_dir_name} for {mirna_id}")
+                return False
+
+        return True
+
     def __init__(self, settings, directories, cores, batch_count):
         self.settings = settings
         self.directories = directories
@@ -104,3 +305,4 @@ class RNAFolder:
 
         self.current_batch = 0
         self.use_caching = literal_eval(settings["use_caching"])
+        self.chunk_size = int(settings["fold_chunk_size"])
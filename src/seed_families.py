@@ -0,0 +1,340 @@
+"""
+Group miRNAs by seed so that work which depends only on the seed is done once per seed family and shared with every member of the family.
+"""
+
+import csv
+import json
+import os
+import re
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from ast import literal_eval
+import pandas as pd
+import numpy as np
+
+from src.conservation_parser import ConservationParser
+from src.shape_parser import ShapeParser
+
+
+class SeedFamilies:
+    """ A grouping of miRNAs which share a seed (nt 2-8), and so share binding sites, target-side windows, target-side folds and conservation/shape scores """
+
+    TARGET_SIDE_FOLDS = [("folds_rnafold_lr", ".csv"), ("folds_rnafold_rl", ".csv"), ("folds_rnafold_ctr", ".csv"), ("folds_rnaplfold", "")]
+    TARGET_SIDE_WINDOWS = ["windows_rnafold_lr", "windows_rnafold_rl", "windows_rnafold_ctr", "windows_rnaplfold"]
+    SUMMARY_FILENAME = "seed-families.txt"
+    TARGET_SITES_FILENAME = "target-sites.tsv"
+    TARGET_SITES_COLUMNS = ["mirna_id", "site_6mer", "target_6mer", "site_6off", "target_6off", "site_7mer_a1", "target_7mer_a1", "site_7mer_m8",
+                            "target_7mer_m8", "site_8mer", "target_8mer"]
+    SITE_COLUMNS = ["ensembl_transcript_id_version", "binding_site_pos"]
+
+    families = None
+    mirna_sequences = None
+
+    def _load_families(self):
+        """ Group each miRNA passing the miRNA filter by its seed, keeping the miRNAs' original order """
+
+        mirna_sequences = pd.read_csv(Path(self.directories["annotations"], "mirna_sequences.tsv"), sep="\t")
+        if self.settings["mirna_id_filter"] != "":
+            mirna_sequences = mirna_sequences[mirna_sequences["mirna_id"].isin(self.settings["mirna_id_filter"].split(","))]
+
+        self.mirna_sequences = dict(zip(mirna_sequences["mirna_id"], mirna_sequences["mirna_sequence"]))
+
+        # note: the first member of each family is its representative, which does the family's shared work
+        use_seed_families = literal_eval(self.settings["use_seed_families"])
+        self.families = OrderedDict()
+        for mirna_id, mirna_sequence in self.mirna_sequences.items():
+            seed = mirna_sequence[1:8] if use_seed_families else mirna_id
+            self.families.setdefault(seed, []).append(mirna_id)
+
+    @property
+    def representatives(self):
+        """ Get the representative miRNA of each family """
+
+        return [members[0] for members in self.families.values()]
+
+    def write_config(self, config_path, mirna_ids):
+        """ Write a copy of the config filtered to the given miRNAs, so the R stages can be run for just those miRNAs """
+
+        with open(config_path, "w", encoding="utf-8") as config_file:
+            json.dump({"settings": dict(self.settings, mirna_id_filter=",".join(mirna_ids)), "directories": self.directories}, config_file)
+
+        return config_path
+
+    def _link_or_copy(self, source_path, destination_path):
+        """ Hard link a file where possible, as shared outputs are only ever replaced rather than rewritten in place """
+
+        try:
+            os.link(source_path, destination_path)
+        except OSError:
+            shutil.copyfile(source_path, destination_path)
+
+    def _share_file(self, source_path, destination_path, link=False):
+        """ Atomically give a member its own copy of one of its representative's files """
+
+        if os.path.exists(destination_path) and os.path.samefile(source_path, destination_path):
+            return  # already linked, and renaming a link over itself would leave the temp file behind
+
+        temp_path = str(destination_path) + ".tmp"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        if link:
+            self._link_or_copy(source_path, temp_path)
+        else:
+            shutil.copyfile(source_path, temp_path)
+
+        os.replace(temp_path, destination_path)
+
+    def _members_to_share(self, members, directory_name, extension):
+        """ Get the members (other than the representative) which don't already have a cached copy of a shared output """
+
+        return [mirna_id for mirna_id in members[1:]
+                if not (self.use_caching and Path(self.directories[directory_name], mirna_id + extension).exists())]
+
+    def share_bindings(self, members):
+        """ Share the representative's located binding sites with the rest of its family """
+
+        representative = members[0]
+        for directory_name in ["bindings", "bindings_raw"]:
+            source_path = Path(self.directories[directory_name], representative + ".tsv")
+            if not source_path.is_file():
+                continue  # the representative has no binding sites, so neither does any member
+
+            for mirna_id in self._members_to_share(members, directory_name, ".tsv"):
+                self._share_file(source_path, Path(self.directories[directory_name], mirna_id + ".tsv"))
+
+    def _reverse_complement(self, sequence):
+        """ Get the DNA reverse complement of a sequence, as reverse_complement.r does """
+
+        return sequence.upper().translate(str.maketrans("TUAGC", "AATCG"))[::-1]
+
+    def write_target_sites(self):
+        """ Write out the sites and target sites of each miRNA with located binding sites, members included, as locate_binding_sites.r does """
+
+        # note: the sites depend only on the seed, so a member's row is rebuilt from its own sequence rather than locating its sites again
+        target_sites = []
+        for mirna_id, mirna_sequence in self.mirna_sequences.items():
+            if not Path(self.directories["bindings_raw"], mirna_id + ".tsv").is_file():
+                continue
+
+            sites = [mirna_sequence[1:7], mirna_sequence[2:8], "T" + mirna_sequence[1:7], mirna_sequence[1:8], "T" + mirna_sequence[1:8]]
+            target_sites.append([mirna_id] + [sequence for site in sites for sequence in (site, self._reverse_complement(site))])
+
+        output_path = Path(self.directories["bindings"], self.TARGET_SITES_FILENAME)
+        pd.DataFrame(target_sites, columns=self.TARGET_SITES_COLUMNS).to_csv(str(output_path) + ".tmp", sep="\t", index=False, quoting=csv.QUOTE_NONE)
+        os.replace(str(output_path) + ".tmp", output_path)
+
+    def _build_mirna_constraint(self, mirna_sequence, site_6mer):
+        """ Mark the miRNA side of a cofold constraint, as extract_windows.r does """
+
+        return re.sub("[A-Za-z]", ".", mirna_sequence.replace(site_6mer, "||||||"))
+
+    def _write_lines(self, path, lines):
+        """ Write one value per line, as write.table does for a single column in extract_windows.r """
+
+        with open(path, "w", encoding="utf-8", newline="") as lines_file:
+            lines_file.write("".join(line + "\n" for line in lines))
+
+    def _build_member_windows(self, representative_windows, mirna_id):
+        """ Build a member's windows table from its representative's, replacing the miRNA side of each cofold window and constraint """
+
+        mirna_sequence = self.mirna_sequences[mirna_id]
+        site_6mer = mirna_sequence[1:7]
+
+        # the mRNA side of each cofold window and constraint depends only on the site, so is taken from the representative as-is
+        windows = representative_windows.copy()
+        windows["cofold_window_full"] = mirna_sequence + "&" + windows["fold_window_lr"]
+        windows["cofold_constraint_full"] = self._build_mirna_constraint(mirna_sequence, site_6mer) + "&" + windows["cofold_constraint_full"].str.split("&").str[1]
+        windows["cofold_window_seed"] = mirna_sequence[:8] + "&" + windows["cofold_window_seed"].str.split("&").str[1]
+        windows["cofold_constraint_seed"] = self._build_mirna_constraint(mirna_sequence[:8], site_6mer) + "&" + windows["cofold_constraint_seed"].str.split("&").str[1]
+
+        return windows
+
+    def share_windows(self, members):
+        """ Share the representative's target-side windows with the rest of its family, building only the miRNA-dependent cofold windows for each member """
+
+        representative = members[0]
+        windows_path = Path(self.directories["windows"], representative + ".tsv")
+        if not windows_path.is_file():
+            return
+
+        representative_windows = pd.read_csv(windows_path, sep="\t", dtype=str, keep_default_na=False)
+
+        for mirna_id in self._members_to_share(members, "windows", ".tsv"):
+            windows = self._build_member_windows(representative_windows, mirna_id)
+
+            for directory_name in self.TARGET_SIDE_WINDOWS:
+                self._share_file(Path(self.directories[directory_name], representative + ".txt"), Path(self.directories[directory_name], mirna_id + ".txt"))
+
+            # each cofold window is a sequence line followed by its constraint line
+            for directory_name, window_column, constraint_column in [("windows_rnacofold_full", "cofold_window_full", "cofold_constraint_full"),
+                                                                     ("windows_rnacofold_seed", "cofold_window_seed", "cofold_constraint_seed")]:
+                interleaved = [line for pair in zip(windows[window_column], windows[constraint_column]) for line in pair]
+                self._write_lines(Path(self.directories[directory_name], mirna_id + ".txt"), interleaved)
+
+            # the windows table is written last, as its presence is what marks a member's windows as done
+            output_path = Path(self.directories["windows"], mirna_id + ".tsv")
+            windows.to_csv(str(output_path) + ".tmp", sep="\t", index=False, quoting=csv.QUOTE_NONE)
+            os.replace(str(output_path) + ".tmp", output_path)
+
+    def share_folds(self, members):
+        """ Share the representative's target-side folds (RNAfold and RNAplfold) with the rest of its family """
+
+        representative = members[0]
+        for directory_name, extension in self.TARGET_SIDE_FOLDS:
+            source_path = Path(self.directories[directory_name], representative + extension)
+            if not source_path.exists():
+                continue
+
+            for mirna_id in self._members_to_share(members, directory_name, extension):
+                destination_path = Path(self.directories[directory_name], mirna_id + extension)
+
+                if source_path.is_dir():
+                    partial_path = Path(str(destination_path) + ".part")
+                    shutil.rmtree(partial_path, ignore_errors=True)
+                    shutil.copytree(source_path, partial_path, copy_function=self._link_or_copy)
+                    shutil.rmtree(destination_path, ignore_errors=True)
+                    os.replace(partial_path, destination_path)
+                else:
+                    self._share_file(source_path, destination_path, link=True)
+
+                # carry over the progress record too, so the shared fold is recognised as complete by the fold cache
+                progress_path = Path(str(source_path) + ".progress")
+                if progress_path.is_file():
+                    self._share_file(progress_path, Path(str(destination_path) + ".progress"))
+
+    def _site_keys(self, features):
+        """ Get the (transcript, position) of each site in a features table, or None if the table doesn't identify its sites """
+
+        if not set(self.SITE_COLUMNS) <= set(features.columns):
+            return None
+
+        return features[self.SITE_COLUMNS].astype(str).to_numpy()
+
+    def _copy_conservation(self, mirna_id, representative_conservation, conservation_columns):
+        """ Copy the representative's conservation scores into a member's features, returning whether they could be copied """
+
+        # scores are copied across row by row, so only when the member's features hold the very same sites in the same order
+        features_path = Path(self.directories["features"], mirna_id + ".tsv")
+        features_with_cons = pd.read_csv(features_path, header="infer", na_values="?", sep="\t", dtype={column: str for column in self.SITE_COLUMNS})
+        representative_sites = self._site_keys(representative_conservation)
+        member_sites = self._site_keys(features_with_cons)
+        if representative_sites is None or member_sites is None or not np.array_equal(member_sites, representative_sites):
+            return False
+
+        for column in conservation_columns:
+            features_with_cons[column] = representative_conservation[column].to_numpy()
+
+        output_path = Path(self.directories["features_conservation"], mirna_id + ".tsv")
+        features_with_cons.to_csv(str(output_path) + ".tmp", sep="\t", index=False)
+        os.replace(str(output_path) + ".tmp", output_path)
+
+        return True
+
+    def share_conservation(self, members):
+        """ Add the representative's conservation scores to each member's own features, parsing them afresh for any member whose sites differ """
+
+        representative = members[0]
+        source_path = Path(self.directories["features_conservation"], representative + ".tsv")
+        if not source_path.is_file():
+            return
+
+        representative_features = pd.read_csv(Path(self.directories["features"], representative + ".tsv"), sep="\t", nrows=0)
+        representative_conservation = pd.read_csv(source_path, sep="\t", dtype=str, keep_default_na=False)
+        conservation_columns = [column for column in representative_conservation.columns if column not in representative_features.columns]
+
+        members_to_share = self._members_to_share(members, "features_conservation", ".tsv")
+        for index, mirna_id in enumerate(members_to_share):
+            if not Path(self.directories["features"], mirna_id + ".tsv").is_file():
+                continue
+
+            if not self._copy_conservation(mirna_id, representative_conservation, conservation_columns):
+                self.conservation_parser.parse_conservation((mirna_id + ".tsv", index, len(members_to_share)))
+
+    def _read_site_keys(self, mirna_id):
+        """ Get the (transcript, position) of each site in a miRNA's features with conservation, which its parsed shape scores are listed against """
+
+        features_with_cons = pd.read_csv(Path(self.directories["features_conservation"], mirna_id + ".tsv"), sep="\t", dtype=str, keep_default_na=False)
+        return self._site_keys(features_with_cons)
+
+    def share_shape(self, members):
+        """ Share the representative's parsed shape reactivity scores with the rest of its family, parsing them afresh for any member whose sites differ """
+
+        representative = members[0]
+        source_path = Path(self.directories["parsed_shape"], representative + ".tsv")
+        if not source_path.is_file():
+            return
+
+        # parsed shape scores only identify each site's transcript, so the sites are compared on the features they were parsed from
+        representative_sites = self._read_site_keys(representative)
+
+        members_to_share = self._members_to_share(members, "parsed_shape", ".tsv")
+        for index, mirna_id in enumerate(members_to_share):
+            if not Path(self.directories["features_conservation"], mirna_id + ".tsv").is_file():
+                continue
+
+            member_sites = self._read_site_keys(mirna_id)
+            if representative_sites is not None and member_sites is not None and np.array_equal(member_sites, representative_sites):
+                self._share_file(source_path, Path(self.directories["parsed_shape"], mirna_id + ".tsv"))
+            else:
+                self.shape_parser.parse_shape((mirna_id + ".tsv", index, len(members_to_share)))
+
+    def _run_batch(self, share):
+        """ Run a share step for every family """
+
+        for members in self.families.values():
+            if len(members) > 1:
+                share(members)
+
+    def share_bindings_batch(self):
+        """ Share binding sites across every family """
+
+        self._run_batch(self.share_bindings)
+
+    def share_windows_batch(self):
+        """ Share target-side windows across every family """
+
+        self._run_batch(self.share_windows)
+
+    def share_folds_batch(self):
+        """ Share target-side folds across every family """
+
+        self._run_batch(self.share_folds)
+
+    def share_conservation_batch(self):
+        """ Share conservation scores across every family """
+
+        self._run_batch(self.share_conservation)
+
+    def share_shape_batch(self):
+        """ Share parsed shape reactivity scores across every family """
+
+        self._run_batch(self.share_shape)
+
+    def write_summary(self):
+        """ Write out the members of each family and report how much shared work deduplication saved """
+
+        mirna_count = len(self.mirna_sequences)
+        family_count = len(self.families)
+
+        with open(Path(self.directories["bindings"], self.SUMMARY_FILENAME), "w", encoding="utf-8", newline="") as summary_file:
+            writer = csv.writer(summary_file, delimiter="\t")
+            writer.writerow(["seed", "representative", "member_count", "members"])
+            writer.writerows([(seed, members[0], len(members), ",".join(members)) for seed, members in self.families.items()])
+
+        if family_count > 0:
+            print(f"Seed families: {mirna_count} miRNAs in {family_count} families, so site location, target-side windows and folds, and conservation/shape "
+                  f"parsing ran {family_count} times rather than {mirna_count} (deduplication ratio {mirna_count / family_count:.2f}x).")
+
+    def __init__(self, settings, directories):
+        self.settings = settings
+        self.directories = directories
+
+        self.use_caching = literal_eval(settings["use_caching"])
+
+        # note: these parse any member whose sites differ from its representative's, so a family's work stays on the core it was given
+        self.conservation_parser = ConservationParser(settings, directories, "1")
+        self.shape_parser = ShapeParser(settings, directories, "1")
+
+        self._load_families()
@@ -99,11 +99,13 @@ class ShapeParser:
 
         print(f"Shape parsing {str(file_index + 1)}/{str(file_count)} - done.")
 
-    def parse_batch(self):
+    def parse_batch(self, mirna_ids=None):
         """ Parse shape reactivity values for a batch of features files """
 
         with Pool(processes=self.cores) as pool:
             features_files = os.listdir(self.directories["features_conservation"])
+            if mirna_ids is not None:
+                features_files = [f for f in features_files if f.split(".")[0] in mirna_ids]
             file_count = len(features_files)
 
             pool.map(self.parse_shape, [(features_filename, file_index, file_count) for (file_index, features_filename) in enumerate(features_files)])
@@ -72,8 +72,8 @@ class ShapeScorer:
 
             print(f"Shape scoring {str(file_index + 1)}/{str(file_count)} - done.")
 
-    def score_batch(self):
-        """ Produce mean reactivity scores for a batch of feature files """
+    def load_shape_sources(self):
+        """ Determine the seed and supplementary columns to average across, one pair per shape source """
 
         # each shape file located in the main shape directory is considered a new dataset
         for shape_filename in os.listdir(self.directories["shape_data"]):
@@ -83,6 +83,11 @@ class ShapeScorer:
             self.shape_seed_cols.append(shape_source + "_seed")
             self.shape_sup_cols.append(shape_source + "_sup")
 
+    def score_batch(self):
+        """ Produce mean reactivity scores for a batch of feature files """
+
+        self.load_shape_sources()
+
         with Pool(processes=self.cores) as pool:
             features_files = os.listdir(self.directories["features_conservation"])
             file_count = len(features_files)
@@ -0,0 +1,424 @@
+"""
+Pre-screen located binding sites with a lightweight model built on cheap, fold-free features so unlikely sites can skip the expensive folding stages.
+"""
+
+import argparse
+import csv
+import json
+import os
+import pickle
+import shutil
+import sys
+from pathlib import Path
+from multiprocessing import Pool
+from ast import literal_eval
+import pandas as pd
+import numpy as np
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from src.conservation_parser import ConservationParser
+from src.prediction_store import PredictionStore
+
+
+class SitePrescreen:
+    """ A tiered filter which scores binding sites straight after they are located and prunes those the full model is unlikely to predict """
+
+    ABUNDANCE_FEATURES = ["site_abundance_6mer", "site_abundance_6off", "site_abundance_7mer", "site_abundance_8mer",
+                          "site_abundance_6cds", "site_abundance_7cds", "site_abundance_8cds"]
+    COMPLEMENTS = {"A": "T", "C": "G", "G": "C", "T": "A", "U": "A"}
+    MODEL_FILENAME = "prescreen.sav"
+    HELD_OUT_FRACTION = 0.2
+
+    # the per-miRNA outputs of stages 04 to 10, all of which are built from a miRNA's located sites
+    DOWNSTREAM_OUTPUTS = [
+        ("windows", ".tsv"), ("windows_rnafold_lr", ".txt"), ("windows_rnafold_rl", ".txt"), ("windows_rnafold_ctr", ".txt"),
+        ("windows_rnacofold_full", ".txt"), ("windows_rnacofold_seed", ".txt"), ("windows_rnaplfold", ".txt"),
+        ("folds_rnafold_lr", ".csv"), ("folds_rnafold_rl", ".csv"), ("folds_rnafold_ctr", ".csv"), ("folds_rnacofold_full", ".csv"),
+        ("folds_rnacofold_seed", ".csv"), ("folds_rnaplfold", ""), ("features", ".tsv"), ("features_conservation", ".tsv"),
+        ("parsed_shape", ".tsv"), ("features_cons_shape", ".tsv"), ("features_full_imputed", ".tsv")
+    ]
+
+    model = None
+    utrs = None
+    mirna_sequences = None
+
+    def _load_utrs(self):
+        """ Load the utr sequences the cheap features are built from """
+
+        utrs = pd.read_csv(Path(self.directories["annotations"], "utr_sequences.tsv"), sep="\t")
+        self.utrs = dict(zip(utrs["ensembl_transcript_id_version"], utrs["X3utr"]))
+
+    def _load_conservation(self, transcript_ids):
+        """ Load the conservation scores of only the given transcripts, as the full tracks are far too large to hold in every process """
+
+        # conservation rows are keyed by transcript id, without the version, followed by a score for each utr base
+        transcript_ids = {transcript_id.split(".")[0] for transcript_id in transcript_ids}
+
+        conservation_tracks = {}
+        for conservation_filename in sorted(os.listdir(self.directories["conservation"])):
+            track = conservation_tracks.setdefault(Path(conservation_filename).stem, {})
+            with open(os.path.join(self.directories["conservation"], conservation_filename), "r", encoding="utf-8") as conservation_file:
+                for line in conservation_file:
+                    transcript_id, _, scores = line.rstrip("\n").partition(" ")
+                    if transcript_id.split(".")[0] in transcript_ids:
+                        track[transcript_id.split(".")[0]] = scores.split(" ")
+
+        return conservation_tracks
+
+    def _sequence_features(self, mirna_id, binding_sites):
+        """ Build the seed type, utr length and AU context of each located site of a miRNA from its utr sequence """
+
+        # bases complementary to miRNA base 8 and the A opposite miRNA base 1 decide whether a 6mer extends to a 7mer or 8mer
+        mirna_sequence = self.mirna_sequences[mirna_id].upper()
+        target_m8 = self.COMPLEMENTS[mirna_sequence[7]] if len(mirna_sequence) >= 8 else None
+
+        features = {name: [] for name in ["seed_m8", "seed_a1", "utr_length", "au_upstream", "au_downstream"]}
+        for transcript_id, binding_site_pos in zip(binding_sites["ensembl_transcript_id_version"], binding_sites["binding_site_pos"]):
+            utr = str(self.utrs.get(transcript_id, "")).upper()
+            start = binding_site_pos - 1  # binding_site_pos counts from 1 and marks the start of the 6mer
+
+            features["seed_m8"].append(0 < start <= len(utr) and utr[start - 1] == target_m8)
+            features["seed_a1"].append(start + 6 < len(utr) and utr[start + 6] == "A")
+            features["utr_length"].append(len(utr))
+
+            upstream = utr[max(start - 30, 0):start]
+            downstream = utr[start + 6:start + 36]
+            features["au_upstream"].append(sum(base in "ATU" for base in upstream) / len(upstream) if upstream else np.nan)
+            features["au_downstream"].append(sum(base in "ATU" for base in downstream) / len(downstream) if downstream else np.nan)
+
+        return features
+
+    def _conservation_features(self, binding_sites):
+        """ Build the seed and supplementary conservation of each located site, for each conservation track """
+
+        conservation_tracks = self._load_conservation(binding_sites["ensembl_transcript_id_version"])
+
+        features = {}
+        for name, track in conservation_tracks.items():
+            scores = [self.conservation_parser.score_target(binding_site_pos, track[transcript_id.split(".")[0]])
+                      if track.get(transcript_id.split(".")[0]) else (np.nan, np.nan, np.nan, np.nan)
+                      for transcript_id, binding_site_pos in zip(binding_sites["ensembl_transcript_id_version"], binding_sites["binding_site_pos"])]
+            features[name + "_seed"] = [seed for seed, _, _, _ in scores]
+            features[name + "_sup"] = [sup for _, sup, _, _ in scores]
+
+        return features
+
+    def extract_cheap_features(self, mirna_id, binding_sites):
+        """ Build the seed type, abundance, utr position, AU context and conservation features for each located site of a miRNA """
+
+        if self.utrs is None:
+            self._load_utrs()
+
+        features = binding_sites[self.ABUNDANCE_FEATURES].astype(float).copy()
+        sequence_features = self._sequence_features(mirna_id, binding_sites)
+
+        features["seed_m8"] = np.array(sequence_features["seed_m8"], dtype=float)
+        features["seed_a1"] = np.array(sequence_features["seed_a1"], dtype=float)
+
+        utr_length = np.array(sequence_features["utr_length"], dtype=float)
+        binding_site_pos = binding_sites["binding_site_pos"].to_numpy(dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            features["utr_length"] = np.log10(utr_length)
+            features["rel_utr_pos"] = binding_site_pos / utr_length
+            features["dist_closest_utr_end"] = np.log10(np.maximum(np.minimum(utr_length - binding_site_pos, binding_site_pos), 1))
+
+        features["au_upstream"] = sequence_features["au_upstream"]
+        features["au_downstream"] = sequence_features["au_downstream"]
+
+        for name, values in self._conservation_features(binding_sites).items():
+            features[name] = values
+
+        return features
+
+    def _load_bindings(self, bindings_filename):
+        """ Load every located site for a miRNA, preferring the unscreened copy if the sites have already been pruned """
+
+        unscreened_path = Path(self.directories["bindings_unscreened"], bindings_filename)
+        bindings_path = unscreened_path if unscreened_path.is_file() else Path(self.directories["bindings"], bindings_filename)
+
+        return pd.read_csv(bindings_path, sep="\t")
+
+    def _score(self, mirna_id, binding_sites):
+        """ Score each site with the lightweight model """
+
+        features = self.extract_cheap_features(mirna_id, binding_sites)
+        return self.model["model"].predict_proba(features[self.model["features"]])[:, 1]
+
+    def _label_sites(self, store, mirna_id):
+        """ Load a miRNA's located sites, labelled by whether the full pipeline went on to predict each one """
+
+        binding_sites = self._load_bindings(mirna_id + ".tsv")
+        predicted = {(p["ensembl_transcript_id_version"], p["binding_pos"]) for p in store.query(mirna_ids=[mirna_id])}
+
+        labels = np.array([(t, p) in predicted for t, p in zip(binding_sites["ensembl_transcript_id_version"], binding_sites["binding_site_pos"])])
+        return binding_sites, labels
+
+    def _split_by_seed(self, mirna_ids):
+        """ Split miRNAs into training and held-out sets by seed family, so that no family's sites are seen both when fitting and when checking """
+
+        seeds = sorted({self.mirna_sequences[mirna_id][1:8] for mirna_id in mirna_ids})
+        if len(seeds) < 2:
+            raise ValueError("The reference run must include miRNAs from at least two seed families, so that recall can be checked on a held-out family.")
+
+        held_out_count = max(1, int(round(len(seeds) * self.HELD_OUT_FRACTION)))
+        held_out_seeds = set(np.random.default_rng(0).permutation(seeds)[:held_out_count])
+
+        training_ids = [mirna_id for mirna_id in mirna_ids if self.mirna_sequences[mirna_id][1:8] not in held_out_seeds]
+        held_out_ids = [mirna_id for mirna_id in mirna_ids if self.mirna_sequences[mirna_id][1:8] in held_out_seeds]
+
+        return training_ids, held_out_ids
+
+    @property
+    def recall(self):
+        """ Get the fraction of the full model's predictions the pre-screen should keep """
+
+        return float(self.settings["prescreen_recall"])
+
+    def _determine_cutoff(self, positive_scores):
+        """ Get the highest score which still keeps the requested fraction of the training miRNAs' predictions """
+
+        return float(positive_scores[int(np.floor((1 - self.recall) * len(positive_scores)))]) if len(positive_scores) > 0 else 0.0
+
+    def train(self, reference_filename):
+        """ Train the lightweight model against the predictions of a completed full pipeline run and pick a recall-preserving cutoff """
+
+        store = PredictionStore(self.directories, reference_filename)
+
+        mirna_ids = [mirna_id for mirna_id in store.mirna_ids()
+                     if mirna_id in self.mirna_sequences and Path(self.directories["bindings"], mirna_id + ".tsv").is_file()]
+        training_ids, held_out_ids = self._split_by_seed(mirna_ids)
+
+        features = []
+        labels = []
+        for mirna_id in training_ids:
+            binding_sites, mirna_labels = self._label_sites(store, mirna_id)
+            features.append(self.extract_cheap_features(mirna_id, binding_sites))
+            labels.append(mirna_labels)
+
+        features = pd.concat(features, ignore_index=True)
+        labels = np.concatenate(labels)
+
+        model = make_pipeline(SimpleImputer(strategy="median"), StandardScaler(), LogisticRegression(class_weight="balanced", max_iter=1000))
+        model.fit(features, labels)
+
+        # the scores of the predicted sites are kept with the model so that the cutoff can follow the recall setting without retraining
+        positive_scores = np.sort(model.predict_proba(features)[:, 1][labels])
+        cutoff = self._determine_cutoff(positive_scores)
+
+        self.model = {"model": model, "features": list(features.columns), "positive_scores": positive_scores, "held_out": held_out_ids}
+        with open(Path(self.directories["model_data"], self.MODEL_FILENAME), "wb") as file:
+            pickle.dump(self.model, file)
+        self.model["cutoff"] = cutoff
+
+        print(f"Pre-screen model trained on {len(training_ids)} miRNAs, {len(labels)} sites ({int(labels.sum())} predicted), "
+              f"cutoff {cutoff:.4f} for {self.recall:.1%} recall.")
+
+        self.check_recall(reference_filename)
+
+    def check_recall(self, reference_filename):
+        """ Measure, offline, how many of a full pipeline run's predictions for the held-out miRNAs would survive pre-screening and how many sites would be pruned """
+
+        store = PredictionStore(self.directories, reference_filename)
+
+        total_sites = 0
+        total_pruned = 0
+        total_predicted = 0
+        total_kept = 0
+        for mirna_id in self.model["held_out"]:
+            if not Path(self.directories["bindings"], mirna_id + ".tsv").is_file():
+                continue
+
+            binding_sites, labels = self._label_sites(store, mirna_id)
+            kept = self._score(mirna_id, binding_sites) >= self.model["cutoff"]
+
+            total_sites += len(kept)
+            total_pruned += int((~kept).sum())
+            total_predicted += int(labels.sum())
+            total_kept += int((kept & labels).sum())
+
+        recall = total_kept / total_predicted if total_predicted > 0 else 1.0
+        print(f"Pre-screen would prune {total_pruned}/{total_sites} sites of {len(self.model['held_out'])} held-out miRNAs "
+              f"and keep {total_kept}/{total_predicted} of their predictions (recall {recall:.2%}).")
+
+        return recall
+
+    def _list_bindings(self, directory_name):
+        """ List the bindings files of each miRNA passing the miRNA filter """
+
+        bindings_files = [f for f in os.listdir(self.directories[directory_name]) if f.endswith(".tsv") and f != "target-sites.tsv"]
+        if self.settings["mirna_id_filter"] != "":
+            bindings_files = [f for f in bindings_files if f.split(".")[0] in self.settings["mirna_id_filter"].split(",")]
+
+        return bindings_files
+
+    def _invalidate_downstream(self, mirna_id):
+        """ Remove every cached output built from a miRNA's sites, so that each later stage is rerun against its new set of sites """
+
+        for directory_name, extension in self.DOWNSTREAM_OUTPUTS:
+            output_path = Path(self.directories[directory_name], mirna_id + extension)
+            for path in [output_path, Path(str(output_path) + ".progress"), Path(str(output_path) + ".part")]:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                elif path.exists():
+                    os.remove(path)
+
+    def _site_keys(self, binding_sites):
+        """ Get the (transcript, position) of each site """
+
+        return list(zip(binding_sites["ensembl_transcript_id_version"], binding_sites["binding_site_pos"]))
+
+    def _load_site_keys(self, bindings_path):
+        """ Get the (transcript, position) of each site in a bindings file, where a missing file holds no sites """
+
+        return self._site_keys(pd.read_csv(bindings_path, sep="\t")) if bindings_path.is_file() else []
+
+    def screen(self, args):
+        """ Prune a miRNA's located sites which score below the cutoff, keeping the full set aside in the unscreened folder """
+
+        bindings_filename, file_index, file_count = args
+        mirna_id = bindings_filename.split(".")[0]
+
+        bindings_path = Path(self.directories["bindings"], bindings_filename)
+        unscreened_path = Path(self.directories["bindings_unscreened"], bindings_filename)
+
+        # keep the full set aside before pruning so an interruption can only ever leave the sites unpruned, then always screen from it
+        # so that a change of model or cutoff is picked up
+        screened_before = literal_eval(self.settings["use_caching"]) and unscreened_path.is_file()
+        if not screened_before and not bindings_path.is_file():
+            return bindings_filename, 0, 0  # no sites were located
+        if not screened_before:
+            shutil.copyfile(bindings_path, str(unscreened_path) + ".tmp")
+            os.replace(str(unscreened_path) + ".tmp", unscreened_path)
+
+        binding_sites = pd.read_csv(unscreened_path, sep="\t")
+        kept = np.zeros(len(binding_sites), dtype=bool)
+        if len(binding_sites) > 0:
+            kept = self._score(mirna_id, binding_sites) >= self.model["cutoff"]
+
+        # the later stages are only cached on their outputs existing, so any which were built from a different set of sites are cleared out
+        # before the pruned sites are written
+        if self._site_keys(binding_sites.loc[kept]) == self._load_site_keys(bindings_path):
+            print(f"Pre-screening {file_index + 1}/{file_count} - {'loaded from cache' if screened_before else 'done'}.")
+            return bindings_filename, len(binding_sites), int(kept.sum())
+
+        self._invalidate_downstream(mirna_id)
+
+        # a miRNA with every site pruned is left without a bindings file, just as locate_binding_sites.r leaves a miRNA with no sites
+        if kept.any():
+            binding_sites.loc[kept].to_csv(str(bindings_path) + ".tmp", sep="\t", index=False)
+            os.replace(str(bindings_path) + ".tmp", bindings_path)
+        else:
+            os.remove(bindings_path)
+
+        print(f"Pre-screening {file_index + 1}/{file_count} - done.")
+
+        return bindings_filename, len(binding_sites), int(kept.sum())
+
+    def screen_batch(self):
+        """ Pre-screen the located sites of a batch of miRNAs and report how many were pruned """
+
+        bindings_files = self._list_bindings("bindings")
+
+        with Pool(processes=self.cores, initializer=_init_worker, initargs=(self.settings, self.directories)) as pool:
+            file_count = len(bindings_files)
+            results = pool.map(_screen, [(bindings_filename, file_index, file_count) for (file_index, bindings_filename) in enumerate(bindings_files)])
+
+        with open(Path(self.directories["bindings_unscreened"], "prescreen-report.txt"), "w", encoding="utf-8", newline="") as report_file:
+            writer = csv.writer(report_file, delimiter="\t")
+            writer.writerow(["mirna_id", "sites", "kept", "pruned"])
+            writer.writerows([(filename.split(".")[0], sites, kept, sites - kept) for filename, sites, kept in results])
+
+        total_sites = sum(sites for _, sites, _ in results)
+        total_kept = sum(kept for _, _, kept in results)
+        print(f"Pre-screening pruned {total_sites - total_kept}/{total_sites} sites using cutoff {self.model['cutoff']:.4f}.")
+
+    def restore(self, bindings_filename):
+        """ Put back the full set of sites for a miRNA pruned by an earlier pre-screened run, as is needed once pre-screening is disabled """
+
+        mirna_id = bindings_filename.split(".")[0]
+
+        bindings_path = Path(self.directories["bindings"], bindings_filename)
+        unscreened_path = Path(self.directories["bindings_unscreened"], bindings_filename)
+        if not unscreened_path.is_file():
+            return
+
+        if self._site_keys(pd.read_csv(unscreened_path, sep="\t")) != self._load_site_keys(bindings_path):
+            self._invalidate_downstream(mirna_id)
+            print(f"Restored the pre-screened sites of {mirna_id}.")
+
+        os.replace(unscreened_path, bindings_path)
+
+    def restore_batch(self):
+        """ Put back the full set of sites for every miRNA pruned by an earlier pre-screened run """
+
+        for bindings_filename in self._list_bindings("bindings_unscreened"):
+            self.restore(bindings_filename)
+
+    def load(self):
+        """ Load a previously trained pre-screen model from file, setting its cutoff from the current recall setting """
+
+        model_path = Path(self.directories["model_data"], self.MODEL_FILENAME)
+        if not model_path.is_file():
+            raise FileNotFoundError(f"No trained pre-screen model was found at {model_path}. Train one against a run made without pre-screening "
+                                    "using `python -m src.site_prescreen train --reference predictions.sqlite`, or disable use_prescreen in the config.")
+
+        with open(model_path, "rb") as file:
+            self.model = pickle.load(file)
+
+        self.model["cutoff"] = self._determine_cutoff(self.model["positive_scores"])
+
+    def __init__(self, settings, directories, cores):
+        self.settings = settings
+        self.directories = directories
+        self.cores = int(cores)
+
+        self.conservation_parser = ConservationParser(settings, directories, cores)
+
+        mirna_sequences = pd.read_csv(Path(self.directories["annotations"], "mirna_sequences.tsv"), sep="\t")
+        self.mirna_sequences = dict(zip(mirna_sequences["mirna_id"], mirna_sequences["mirna_sequence"]))
+
+        Path(self.directories["bindings_unscreened"]).mkdir(parents=True, exist_ok=True)
+
+
+# each worker process builds its own pre-screen once, rather than having it pickled across for every miRNA
+_WORKER = {}
+
+
+def _init_worker(settings, directories):
+    """ Prepare the pre-screen within a worker process """
+
+    _WORKER["prescreen"] = SitePrescreen(settings, directories, 1)
+    _WORKER["prescreen"].load()
+
+
+def _screen(args):
+    """ Pre-screen the sites of a single miRNA within a worker process """
+
+    return _WORKER["prescreen"].screen(args)
+
+
+def main():
+    """ Command line entry point for training the pre-screen model and checking its recall against a full pipeline run """
+
+    parser = argparse.ArgumentParser(description="Train or check the miRsight binding site pre-screen.")
+    parser.add_argument("command", choices=["train", "check"])
+    parser.add_argument("--config", default="config.json", help="path to the miRsight config file")
+    parser.add_argument("--reference", default="predictions.sqlite", help="prediction store, in the predictions folder, from a run without pre-screening")
+    args = parser.parse_args()
+
+    with open(args.config, "r", encoding="utf-8") as config_file:
+        config = json.load(config_file)
+
+    prescreen = SitePrescreen(config["settings"], config["directories"], 1)
+    if args.command == "train":
+        prescreen.train(args.reference)
+    else:
+        prescreen.load()
+        prescreen.check_recall(args.reference)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
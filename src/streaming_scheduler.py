@@ -0,0 +1,390 @@
+"""
+Stream batches of seed families of miRNAs through the per-miRNA stages of the pipeline, so that predictions are made as each batch finishes rather than at the end.
+"""
+
+import os
+import queue
+import sqlite3
+import subprocess
+import tempfile
+import threading
+from collections import namedtuple
+from multiprocessing import Pool
+from pathlib import Path
+from ast import literal_eval
+
+from src.feature_extractor import FeatureExtractor
+from src.machine_learning import MachineLearning
+from src.rna_folder import RNAFolder
+from src.seed_families import SeedFamilies
+from src.shape_scorer import ShapeScorer
+from src.site_prescreen import SitePrescreen
+
+
+# a batch of seed families (each a list of miRNAs, representative first) and its place in the stream, along with the folder its R configs are written to
+Batch = namedtuple("Batch", ["families", "file_index", "file_count", "config_dir"])
+
+
+class FamilyStages:
+    """ The per-miRNA stages of the pipeline, run for a batch of seed families on a single core and returning the families which should continue on """
+
+    def _run_rscript(self, script, batch, mirna_ids):
+        """ Run one of the R stages for only the given miRNAs of a batch """
+
+        # note: each R call reloads the annotations, so a call covers the whole batch rather than a single family
+        config_path = self.seed_families.write_config(os.path.join(batch.config_dir, f"{batch.file_index}.json"), mirna_ids)
+        subprocess.run(["Rscript", script, config_path, "1"], shell=False, check=True)
+
+    def _with_output(self, families, directory_name):
+        """ Get the families whose representative has an output in the given directory """
+
+        return [members for members in families if Path(self.directories[directory_name], members[0] + ".tsv").is_file()]
+
+    def locate(self, batch):
+        """ Locate the binding sites of each family's representative and share them with the family, dropping any family without sites """
+
+        self._run_rscript("src/locate_binding_sites.r", batch, [members[0] for members in batch.families])
+        for members in batch.families:
+            self.seed_families.share_bindings(members)
+
+        return self._with_output(batch.families, "bindings")
+
+    def prescreen(self, batch):
+        """ Prune each member's binding sites using the cheap-feature pre-screen, dropping any family with none kept """
+
+        for members in batch.families:
+            for mirna_id in members:
+                self.site_prescreen.screen((mirna_id + ".tsv", batch.file_index, batch.file_count))
+
+        # the representative's sites may all have been pruned, leaving the family with none
+        return self._with_output(batch.families, "bindings")
+
+    def restore(self, batch):
+        """ Put back any of each member's binding sites pruned by an earlier pre-screened run """
+
+        for members in batch.families:
+            for mirna_id in members:
+                self.site_prescreen.restore(mirna_id + ".tsv")
+
+        return batch.families
+
+    def windows(self, batch):
+        """ Extract the folding windows of each family's representative, then build each member's own cofold windows """
+
+        self._run_rscript("src/extract_windows.r", batch, [members[0] for members in batch.families])
+        for members in batch.families:
+            self.seed_families.share_windows(members)
+
+        return self._with_output(batch.families, "windows")
+
+    def _fold_family(self, members):
+        """ Fold a family's representative's windows and each member's cofold windows, sharing the target-side folds with the family """
+
+        folded = self.rna_folder.fold_mirna(members[0])
+        folded = all(self.rna_folder.fold_mirna(mirna_id, include_target_side=False) for mirna_id in members[1:]) and folded
+        self.seed_families.share_folds(members)
+
+        return folded
+
+    def fold(self, batch):
+        """ Fold each family's windows using ViennaRNA, dropping any family which fails to fold """
+
+        return [members for members in batch.families if self._fold_family(members)]
+
+    def features(self, batch):
+        """ Extract the features for each of each member's binding sites """
+
+        if self.feature_extractor is not None:
+            for members in batch.families:
+                for mirna_id in members:
+                    self.feature_extractor.extract_features((mirna_id + ".tsv", batch.file_index, batch.file_count))
+        else:
+            self._run_rscript("src/extract_features.r", batch, [mirna_id for members in batch.families for mirna_id in members])
+
+        return self._with_output(batch.families, "features")
+
+    def conservation(self, batch):
+        """ Parse conservation scores for each representative's binding sites and share them with its family """
+
+        # note: the family's own parser is used, as it is also what parses any member whose sites differ from the representative's
+        for members in batch.families:
+            self.seed_families.conservation_parser.parse_conservation((members[0] + ".tsv", batch.file_index, batch.file_count))
+            self.seed_families.share_conservation(members)
+
+        return batch.families
+
+    def shape(self, batch):
+        """ Parse shape reactivity values for each representative's binding sites, then produce average shape scores for each member """
+
+        # note: as with conservation, the family's own parser is used
+        for members in batch.families:
+            self.seed_families.shape_parser.parse_shape((members[0] + ".tsv", batch.file_index, batch.file_count))
+            self.seed_families.share_shape(members)
+
+            for mirna_id in members:
+                self.shape_scorer.score_shape((mirna_id + ".tsv", batch.file_index, batch.file_count))
+
+        return batch.families
+
+    def impute(self, batch):
+        """ Impute any missing values for each member """
+
+        self._run_rscript("src/impute_missing_values.r", batch, [mirna_id for members in batch.families for mirna_id in members])
+
+        return batch.families
+
+    def __init__(self, settings, directories):
+        self.directories = directories
+
+        # note: each stage runs on a single core, as the scheduler's worker budget is what spreads the cores across batches
+        self.seed_families = SeedFamilies(settings, directories)
+        self.rna_folder = RNAFolder(settings, directories, "1", 6)
+        self.shape_scorer = ShapeScorer(settings, directories, "1")
+        self.shape_scorer.load_shape_sources()
+
+        self.feature_extractor = None
+        if literal_eval(settings["use_vectorised_features"]):
+            self.feature_extractor = FeatureExtractor(settings, directories, "1")
+
+        self.site_prescreen = SitePrescreen(settings, directories, "1")
+        if literal_eval(settings["use_prescreen"]):
+            self.site_prescreen.load()
+
+
+# each worker process builds its own stages once, rather than having them pickled across for every task
+_WORKER = {}
+
+
+def _init_worker(settings, directories):
+    """ Prepare the per-miRNA stages within a worker process """
+
+    _WORKER["stages"] = FamilyStages(settings, directories)
+
+
+def _run_stage(stage, batch):
+    """ Run a single stage for a single batch within a worker process """
+
+    return getattr(_WORKER["stages"], stage)(batch)
+
+
+class BatchQueue:
+    """ The batches waiting on their next stage or on prediction, with those furthest along served first and a cap on how many are in the pipeline at once """
+
+    def admit(self, batches):
+        """ Feed each batch into the first stage, holding back whenever the pipeline is full """
+
+        # note: a batch takes up one of the pipeline's slots until it is retired, so putting a slot blocks while every slot is taken
+        for batch in batches:
+            self.slots.put(batch.file_index)
+            self.ready.put((0, batch.file_index, batch))
+
+    def next_stage(self):
+        """ Wait for the next batch due a stage, returning the batch and the index of that stage (or None once the pipeline is closed) """
+
+        priority, _, batch = self.ready.get()
+        return (batch, -priority) if batch is not None else None
+
+    def next_prediction(self):
+        """ Wait for the next batch to come out of the last stage, returning None once the pipeline is closed """
+
+        return self.predictions.get()
+
+    def advance(self, batch, stage_index):
+        """ Pass a batch which has cleared a stage on to the next stage, or on to prediction after the last """
+
+        if stage_index + 1 < self.stage_count:
+            self.ready.put((-(stage_index + 1), batch.file_index, batch))
+        else:
+            self.predictions.put(batch)
+
+    def retire(self):
+        """ Free a retired batch's slot for the next one """
+
+        self.slots.get()
+
+    def close(self, worker_count):
+        """ Wake each worker and the predictor so they can exit """
+
+        for worker_index in range(worker_count):
+            self.ready.put((1, worker_index, None))
+        self.predictions.put(None)
+
+    def __init__(self, stage_count, queue_size):
+        self.stage_count = stage_count
+
+        self.ready = queue.PriorityQueue()
+        self.predictions = queue.Queue()
+        self.slots = queue.Queue(maxsize=queue_size)
+
+
+class StreamingProgress:
+    """ A tally of the miRNAs which have made it through the pipeline, and of how many of those were predicted """
+
+    def record(self, mirna_ids, predicted):
+        """ Report on each miRNA leaving the pipeline, returning whether every miRNA is now through """
+
+        with self.lock:
+            for mirna_id in mirna_ids:
+                self.finished_count += 1
+                if mirna_id in predicted:
+                    self.predicted_count += 1
+                    print(f"Streaming {self.finished_count}/{self.mirna_count} - {mirna_id} predicted.")
+                else:
+                    print(f"Streaming {self.finished_count}/{self.mirna_count} - {mirna_id} has no predictions.")
+
+            return self.finished_count == self.mirna_count
+
+    def report(self):
+        """ Report how many miRNAs were predicted """
+
+        print(f"Streaming produced predictions for {self.predicted_count}/{self.mirna_count} miRNAs.")
+
+    def __init__(self, mirna_count):
+        self.mirna_count = mirna_count
+        self.finished_count = 0
+        self.predicted_count = 0
+        self.lock = threading.Lock()
+
+
+class StreamingScheduler:
+    """ A scheduler which pipelines batches of seed families through the per-miRNA stages, with a bounded number of batches in flight sharing a fixed worker budget """
+
+    def _determine_stages(self):
+        """ Get the ordered names of the stages each batch passes through before prediction """
+
+        stages = ["locate", "windows", "fold", "features", "conservation", "shape", "impute"]
+        stages.insert(1, "prescreen" if literal_eval(self.settings["use_prescreen"]) else "restore")
+
+        return stages
+
+    def _record(self, families, predicted):
+        """ Record the members of families leaving the pipeline, returning whether every miRNA is now through """
+
+        # clear out any predictions a previous run left for miRNAs which dropped out of this one
+        # note: a failure here must not stop the families being recorded, or the pipeline would be left waiting on them
+        mirna_ids = [mirna_id for members in families for mirna_id in members]
+        dropped = [mirna_id for mirna_id in mirna_ids if mirna_id not in predicted]
+        if dropped:
+            try:
+                self.machine_learning.store.remove_predictions(dropped)
+            except sqlite3.Error as e:
+                print(f"An error occurred clearing out the previous predictions for {', '.join(dropped)}: {e}")
+
+        return self.progress.record(mirna_ids, predicted)
+
+    def _finish(self, batch, predicted):
+        """ Retire a batch from the pipeline, freeing its place for the next one """
+
+        all_finished = self._record(batch.families, predicted)
+        self.batch_queue.retire()
+
+        if all_finished:
+            self.batch_queue.close(self.cores)
+
+    def _work(self, pool):
+        """ Repeatedly run the next ready stage, favouring batches which are furthest along so that they finish first """
+
+        stages = self._determine_stages()
+        while True:
+            next_stage = self.batch_queue.next_stage()
+            if next_stage is None:
+                return
+
+            batch, stage_index = next_stage
+
+            # note: any error only drops the batch it occurred for- letting it escape would end this worker, and the pipeline would be left
+            # waiting on the batch forever
+            try:
+                with self.budget:
+                    remaining = pool.apply(_run_stage, (stages[stage_index], batch))
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"An error occurred during the {stages[stage_index]} stage for {', '.join(members[0] for members in batch.families)}: {e}")
+                remaining = []
+
+            if not remaining:
+                self._finish(batch, [])
+                continue
+
+            # families which dropped out of the stage leave straight away, while the rest of the batch carries on
+            self._record([members for members in batch.families if members not in remaining], [])
+            self.batch_queue.advance(batch._replace(families=remaining), stage_index)
+
+    def _predict(self):
+        """ Make predictions for each batch as it comes out of the last stage, flushing them to the prediction output straight away """
+
+        # note: predictions are made in this single thread so that writes to the shared prediction output are never interleaved
+        while True:
+            batch = self.batch_queue.next_prediction()
+            if batch is None:
+                return
+
+            predicted = []
+            with self.budget:
+                for mirna_id in [mirna_id for members in batch.families for mirna_id in members]:
+                    if not Path(self.directories["features_full_imputed"], mirna_id + ".tsv").is_file():
+                        continue
+
+                    # note: as with the stages, an error only drops the miRNA it occurred for, as this thread is the only one making predictions
+                    try:
+                        self.machine_learning.predict_mirna(mirna_id)
+                        predicted.append(mirna_id)
+                    except Exception as e:  # pylint: disable=broad-exception-caught
+                        print(f"An error occurred making predictions for {mirna_id}: {e}")
+
+            self._finish(batch, predicted)
+
+    def run(self):
+        """ Stream every family through the pipeline, returning once each miRNA has either been predicted or dropped out """
+
+        seed_families = SeedFamilies(self.settings, self.directories)
+        families = list(seed_families.families.values())
+
+        self.progress = StreamingProgress(sum(len(members) for members in families))
+        self.machine_learning.reset_predictions([mirna_id for members in families for mirna_id in members])
+        if not families:
+            return
+
+        # the in-flight cap bounds how many batches are queued between stages, and is kept above the worker budget so that a worker is never left
+        # idle waiting for a batch to be admitted
+        queue_size = int(self.settings["streaming_queue_size"])
+        self.batch_queue = BatchQueue(len(self._determine_stages()), queue_size if queue_size != -1 else self.cores * 2)
+
+        # each R stage is run once per batch, so the annotations are only reloaded once for every few families
+        batch_size = int(self.settings["streaming_batch_size"])
+        batch_count = -(-len(families) // batch_size)
+
+        with tempfile.TemporaryDirectory() as config_dir, \
+                Pool(processes=self.cores, initializer=_init_worker, initargs=(self.settings, self.directories)) as pool:
+
+            batches = [Batch(families[batch_index * batch_size:(batch_index + 1) * batch_size], batch_index, batch_count, config_dir)
+                       for batch_index in range(batch_count)]
+
+            threads = [threading.Thread(target=self.batch_queue.admit, args=(batches,)), threading.Thread(target=self._predict)]
+            threads.extend(threading.Thread(target=self._work, args=(pool,)) for _ in range(self.cores))
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        seed_families.write_target_sites()
+
+    def report(self):
+        """ Report how many miRNAs the last run produced predictions for """
+
+        if self.progress is not None:
+            self.progress.report()
+
+    def __init__(self, settings, directories, cores):
+        self.settings = settings
+        self.directories = directories
+        self.cores = int(cores)
+
+        self.batch_queue = None
+        self.progress = None
+
+        # the worker budget caps how many stages (across all batches) run at once
+        self.budget = threading.BoundedSemaphore(self.cores)
+
+        self.machine_learning = MachineLearning(settings, directories, "1")
+        self.machine_learning.bind_model("rf.sav", "scaler.sav")
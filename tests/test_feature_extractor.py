@@ -0,0 +1,206 @@
+"""
+Check the vectorised feature engine against values worked through by hand from extract_features.r, for a fixed set of duplexes and windows.
+"""
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from src.feature_extractor import FeatureExtractor
+
+
+MIRNA = "UAGCAGCACGUAAAUAUUGGCG"
+
+# each duplex is the miRNA and a target site joined by &, as written by RNAcofold, along with its structure
+DUPLEXES = {
+    # 8mer: bases 2-12 bound, with a GU wobble at base 11 and the A opposite base 1 left unpaired
+    "8mer": (MIRNA + "&AAUGCGUGCUGCUA", "." + "(" * 11 + "." * 10 + "&.." + ")" * 11 + "."),
+    # 7mer-a1: bases 2-7 bound, with a self bind at bases 15/20 which is discounted when ignoring second structure binds
+    "7mer-a1": (MIRNA + "&GGAGCUGCUA", "." + "(" * 6 + "." * 7 + "(....)..&...))))))."),
+    # 6mer: bases 1-8 and 10-13 bound (with a bulge at base 9), where bases 1 (UG), 8 (AG) and 13 (AC) are wobbles
+    "6mer": (MIRNA + "&UCUACGGCUGCUG", "(" * 8 + "." + "(" * 4 + "." * 9 + "&." + ")" * 12),
+    # 7mer-m8: bases 2-8 bound, with a C opposite base 1
+    "7mer-m8": (MIRNA + "&AAUGCUGCUC", "." + "(" * 7 + "." * 14 + "&..)))))))."),
+    # 8mer with base 1 bound too
+    "8mer-pp1": (MIRNA + "&AAUGCGUGCUGCUA", "(" * 12 + "." * 10 + "&.." + ")" * 12)
+}
+
+# (perfect_pair_count, longest_any_sequence, longest_any_sequence_start, any_pair_avg_dist, gu_count, mrna_binding_spread) per window
+EXPECTED_WINDOW_FEATURES = {
+    "8mer": {"12_17": [1, 1, 12, 0, 0, 0], "09_20": [3, 4, 9, 1, 1, 3], "full": [10, 11, 2, 1, 1, 10]},
+    "7mer-a1": {"12_17": [0, 0, 0, 0, 0, 0], "09_20": [0, 0, 0, 0, 0, 0], "full": [6, 6, 2, 1, 0, 5]},
+    "6mer": {"12_17": [1, 2, 12, 1, 0, 1], "09_20": [3, 4, 10, 1, 0, 3], "full": [9, 8, 1, 12 / 11, 1, 11]},
+    "7mer-m8": {"12_17": [0, 0, 0, 0, 0, 0], "09_20": [0, 0, 0, 0, 0, 0], "full": [7, 7, 2, 1, 0, 6]},
+    "8mer-pp1": {"12_17": [1, 1, 12, 0, 0, 0], "09_20": [3, 4, 9, 1, 1, 3], "full": [11, 12, 1, 1, 1, 11]}
+}
+
+# (seed_binding_count, seed_binding_type, perfect_pair_1, gu_1, gu_8, perfect_pair_9, gu_9, perfect_pair_10, gu_10, mirna_1, mirna_8, mrna_8)
+EXPECTED_SEED_FEATURES = {
+    "8mer": [8, "8mer", False, False, False, True, False, True, False, "U", "A", "U"],
+    "7mer-a1": [7, "7mer-a1", False, False, False, True, False, False, False, "U", "A", "A"],
+    "6mer": [6, "6mer", False, True, False, False, False, False, False, "U", "A", "G"],
+    "7mer-m8": [7, "7mer-m8", False, False, False, False, False, False, False, "U", "A", "U"],
+    "8mer-pp1": [8, "8mer", True, False, False, True, False, True, False, "U", "A", "U"]
+}
+
+# the 5' AU content weights of extract_features.r, 1/3 for the base closest to the seed down to 1/32
+AU_WEIGHT_TOTAL = sum(1 / d for d in range(3, 33))
+
+SETTINGS = {"use_caching": "False", "ignore_second_struct_bind": "True", "mirna_id_filter": ""}
+DIRECTORY_NAMES = ["annotations", "bindings", "windows", "features", "folds_rnafold_lr", "folds_rnafold_rl", "folds_rnafold_ctr",
+                   "folds_rnacofold_full", "folds_rnacofold_seed", "folds_rnaplfold"]
+
+
+class TestFeatureExtractor(unittest.TestCase):
+    """ Parity checks of FeatureExtractor against extract_features.r """
+
+    # the hand-worked values check each feature helper on its own, so the helpers are called directly
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.temp_dir.cleanup)
+        self.directories = {name: os.path.join(self.temp_dir.name, name) for name in DIRECTORY_NAMES}
+        for directory in self.directories.values():
+            os.makedirs(directory)
+
+        pd.DataFrame({"ensembl_transcript_id_version": ["ENST0001.1", "ENST0002.1"], "X3_utr_length": [500, 80], "cds_length": [900, 300]}) \
+            .to_csv(Path(self.directories["annotations"], "annotations.tsv"), sep="\t", index=False)
+
+        self.feature_extractor = FeatureExtractor(SETTINGS, self.directories, "1")
+
+    def test_duplex_features(self):
+        """ Window, seed type and single base features of each duplex match extract_features.r """
+
+        names = list(DUPLEXES)
+        rnacofolds = pd.DataFrame({"sequence": [DUPLEXES[name][0] for name in names], "struct": [DUPLEXES[name][1] for name in names], "mfe": 0.0})
+        features = self.feature_extractor._extract_duplex_features(rnacofolds)
+
+        seed_columns = ["seed_binding_count", "seed_binding_type", "perfect_pair_1", "gu_1", "gu_8", "perfect_pair_9", "gu_9",
+                        "perfect_pair_10", "gu_10", "mirna_1", "mirna_8", "mrna_8"]
+
+        for row, name in enumerate(names):
+            with self.subTest(duplex=name):
+                self.assertEqual([features.loc[row, column] for column in seed_columns], EXPECTED_SEED_FEATURES[name])
+
+                for window, expected in EXPECTED_WINDOW_FEATURES[name].items():
+                    actual = [features.loc[row, f"{feature}_{window}"] for feature in FeatureExtractor.WINDOW_FEATURES]
+                    np.testing.assert_allclose(actual, expected, err_msg=f"window {window}")
+
+    def test_au_content_features(self):
+        """ 3', supplementary and distance weighted 5' AU content match extract_features.r, including its NA cases """
+
+        windows_lr = pd.Series(["AUGCAUGCAU" + "GGCCGGCC", "AAAA" + "GGCCGGCC", "GC" + "GGCCGGCC"])
+        windows_rl = pd.Series(["GGGGGGGG" + "AUGCGCAUAU", "GGGGGGGG" + "AU", "GGGGGGGG" + "G" * 30 + "A"])
+
+        features = self.feature_extractor._extract_au_content_features(windows_lr, windows_rl)
+
+        np.testing.assert_allclose(features["au_content_3"], [0.6, 1.0, 0.0])
+        # a 5' window too short to hold the supplementary region has no supplementary AU content
+        np.testing.assert_allclose(features["au_content_sup"], [0.5, np.nan, 0.0])
+        # an AU more than 30 bases beyond the seed falls outside the weights, which extract_features.r reports as NA
+        np.testing.assert_allclose(features["au_content_5_weighted"], [
+            (1 / 3 + 1 / 4 + 1 / 9 + 1 / 10 + 1 / 11 + 1 / 12) / AU_WEIGHT_TOTAL,
+            (1 / 3 + 1 / 4) / AU_WEIGHT_TOTAL,
+            np.nan
+        ])
+
+    def test_best_abundance(self):
+        """ The strongest site of each transcript with several sites is flagged as extract_features.r does """
+
+        combined_features = pd.DataFrame({
+            "ensembl_transcript_id_version": ["A", "B", "B", "B", "C", "D", "D", "E", "E"],
+            "site_abundance_6mer": [1, 3, 3, 3, 1, 2, 2, 2, 2],
+            "seed_binding_count": [6, 7, 7, 8, 6, 6, 6, 7, 7],
+            "rnacofold_full_mfe": [-1.0, -5.0, -9.0, -2.0, 0.0, 1.0, 2.0, -3.0, -3.0]
+        })
+
+        # B- most seed bases wins over the strongest mfe; D- a 6mer must have a negative mfe to be a candidate; E- ties keep the first site
+        self.assertEqual(list(self.feature_extractor._determine_best_abundance(combined_features)), [True, False, False, True, True, False, False, True, False])
+
+    def _write_mirna_inputs(self):
+        """ Write the bindings, windows and folds of a single miRNA with three sites, listed out of transcript order """
+
+        sites = [("ENST0002.1", "8mer", 1, 70, -12.3), ("ENST0001.1", "7mer-a1", 2, 40, -8.0), ("ENST0001.1", "7mer-m8", 2, 300, -6.0)]
+
+        pd.DataFrame({"ensembl_transcript_id_version": [site[0] for site in sites], "site_abundance_6mer": [site[2] for site in sites],
+                      "binding_site_pos": [site[3] for site in sites]}).to_csv(Path(self.directories["bindings"], "m1.tsv"), sep="\t", index=False)
+        pd.DataFrame({"ensembl_transcript_id_version": [site[0] for site in sites], "rnaplfold_6mer_pos": 5}) \
+            .to_csv(Path(self.directories["windows"], "m1.tsv"), sep="\t", index=False)
+
+        # the lr/rl/ctr fold mfes pick lr (on a tie), rl and ctr respectively
+        rnafolds = {
+            "lr": [("AUGCAUGCAU" + "GGCCGGCC", -3.1), ("AAAA" + "GGCCGGCC", -1.0), ("GC" + "GGCCGGCC", -2.0)],
+            "rl": [("GGGGGGGG" + "AUGCGCAUAU", -2.0), ("GGGGGGGG" + "AU", -4.5), ("GGGGGGGG" + "G" * 30 + "A", -2.5)],
+            "ctr": [("GGGGGGGGGG", -3.1), ("GGGGGGGGGG", -4.5), ("GGGGGGGGGG", -7.25)]
+        }
+        for direction, folds in rnafolds.items():
+            with open(Path(self.directories["folds_rnafold_" + direction], "m1.csv"), "w", encoding="utf-8") as folds_file:
+                folds_file.write("".join(f"{sequence}\n" + "." * len(sequence) + f" ({mfe:6.2f})\n" for sequence, mfe in folds))
+
+        for variety in ["full", "seed"]:
+            with open(Path(self.directories["folds_rnacofold_" + variety], "m1.csv"), "w", encoding="utf-8") as folds_file:
+                folds_file.write("seq_num,seq_id,seq,mfe_struct,mfe\n")
+                folds_file.write("".join(f"{i + 1},s{i + 1},{DUPLEXES[site[1]][0]},{DUPLEXES[site[1]][1]},{site[4]}\n" for i, site in enumerate(sites)))
+
+        # only the first site has an RNAplfold output, where the unpaired probability of row r, span l is r / 100 + l / 10000
+        Path(self.directories["folds_rnaplfold"], "m1").mkdir()
+        with open(Path(self.directories["folds_rnaplfold"], "m1", "sequence_0001_lunp"), "w", encoding="utf-8") as lunp_file:
+            lunp_file.write("#unpaired probabilities\n#i$\t" + "\t".join(f"l={span}" for span in range(1, 15)) + "\n")
+            lunp_file.write("".join(f"{row}\t" + "\t".join(f"{row / 100 + span / 10000:.4f}" for span in range(1, 15)) + "\n" for row in range(1, 41)))
+
+    def test_extract_features_no_sites(self):
+        """ A miRNA without target sites is given no features file """
+
+        pd.DataFrame({"ensembl_transcript_id_version": [], "site_abundance_6mer": [], "binding_site_pos": []}) \
+            .to_csv(Path(self.directories["bindings"], "m1.tsv"), sep="\t", index=False)
+        self.feature_extractor.extract_features(("m1.tsv", 0, 1))
+
+        self.assertFalse(Path(self.directories["features"], "m1.tsv").exists())
+
+    def test_extract_features(self):
+        """ A miRNA's features file keeps the columns, row order and TRUE/FALSE/NA encoding of extract_features.r """
+
+        self._write_mirna_inputs()
+        self.feature_extractor.extract_features(("m1.tsv", 0, 1))
+
+        features = pd.read_csv(Path(self.directories["features"], "m1.tsv"), sep="\t", dtype=str, keep_default_na=False)
+
+        window_columns = [f"{feature}_{window}" for window in ["12_17", "09_20", "full"] for feature in FeatureExtractor.WINDOW_FEATURES]
+        self.assertEqual(list(features.columns), [
+            "ensembl_transcript_id_version", "gu_1", "gu_8", "perfect_pair_9", "gu_9", "perfect_pair_10", "gu_10", "mirna_1", "mirna_8", "mrna_8",
+            "seed_binding_count", "seed_binding_type", "perfect_pair_1"
+        ] + window_columns + [
+            "site_abundance_6mer", "binding_site_pos", "au_content_3", "au_content_sup", "au_content_5_weighted", "rnafold_mfe", "rnafold_direction",
+            "rnacofold_full_mfe", "rnacofold_seed_mfe", "rnaplfold_seed", "rnaplfold_sup", "X3_utr_length", "cds_length", "dist_closest_utr_end", "best_abundance"
+        ])
+
+        # rows are sorted by transcript by the merge with the annotations, with every feature staying with its own site
+        self.assertEqual(list(features["seed_binding_type"]), ["7mer-a1", "7mer-m8", "8mer"])
+        self.assertEqual(list(features["binding_site_pos"]), ["40", "300", "70"])
+        self.assertEqual(list(features["perfect_pair_9"]), ["TRUE", "FALSE", "TRUE"])
+        self.assertEqual(list(features["best_abundance"]), ["TRUE", "FALSE", "TRUE"])
+        self.assertEqual(features.loc[0, "au_content_sup"], "NA")
+        self.assertEqual(features.loc[1, "au_content_5_weighted"], "NA")
+        self.assertEqual(list(features["rnaplfold_seed"])[:2], ["NA", "NA"])
+        self.assertEqual(list(features["rnaplfold_sup"])[:2], ["NA", "NA"])
+
+        numeric = features.replace("NA", np.nan).drop(columns=["ensembl_transcript_id_version", "mirna_1", "mirna_8", "mrna_8", "seed_binding_type"])
+        numeric = numeric.replace({"TRUE": 1, "FALSE": 0}).astype(float)
+
+        np.testing.assert_allclose(numeric["rnafold_mfe"], [-4.5, -7.25, -3.1])
+        np.testing.assert_allclose(numeric["rnafold_direction"], [1, 0, -1])
+        np.testing.assert_allclose(numeric["rnacofold_full_mfe"], [-8.0, -6.0, -12.3])
+        np.testing.assert_allclose(numeric["au_content_3"], [1.0, 0.0, 0.6])
+        np.testing.assert_allclose(numeric["au_content_sup"], [np.nan, 0.0, 0.5])
+        np.testing.assert_allclose(numeric["dist_closest_utr_end"], [40, 200, 10])
+        # 8mer at 6mer position 5- the seed starts at base 4 and spans 8 bases (row 12, span 8), the supplementary region is row 23, span 12
+        np.testing.assert_allclose(numeric.loc[2, ["rnaplfold_seed", "rnaplfold_sup"]], [0.1208, 0.2312])
+        np.testing.assert_allclose(numeric.loc[2, window_columns], sum((EXPECTED_WINDOW_FEATURES["8mer"][window] for window in ["12_17", "09_20", "full"]), []))
+
+
+if __name__ == "__main__":
+    unittest.main()